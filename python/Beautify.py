@@ -37,18 +37,41 @@ logged changes may not actually be saved if the user chooses not to.
 try:
     import csv
     import logging
+    import os
     import traceback
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
     import ImarisLib
     from XTBatch import XTBatch
     import tkinter as tk
     from tkinter import messagebox
     from tkinter import filedialog
     from tqdm.contrib.itertools import product
+    import numpy as np
+    from utils import get_dtype_info, load_channel_volume, store_channel_volume
 except Exception as e:
     print(e)
     input("Press enter to exit;")
     raise
 
+#nonessential dependences
+try:
+    import cv2
+    cv2_enabled=True
+except Exception as e:
+    print(e)
+    print('OpenCV unavailable; falling back to the Imaris Gaussian filter.')
+    cv2_enabled=False
+
+
+# Sigma (in voxels) from which the Gaussian is approximated by box filters.
+# Below this the exact kernel is small enough that it is not slower.
+BOX_BLUR_MIN_SIGMA = 3
+
+# Upper bound on the memory used by the channels being beautified at once. Each
+# channel in flight holds the volume read from Imaris and two working volumes of
+# the same size.
+CHANNEL_CACHE_BYTES = 1024 * 1024 * 1024
 
 LOG_FORMAT = '%(asctime)s %(levelname)s [%(pathname)s:%(lineno)d %(name)s] %(message)s'
 
@@ -141,6 +164,13 @@ def ApplyBeautification(vImarisApplication,filter_width,curr_max):
     #     curr_max=[curr_max]*vNumChannels
     # else:
     #     raise(Exception(''))
+    if cv2_enabled:
+        sigmas = [filter_width / voxel_size for voxel_size in GetVoxelSize(vImage)]
+        BeautifyChannels(vImage, vNumChannels, curr_max, sigmas)
+        for i in range(vNumChannels):
+            logging.info(f'Stretching channel {i} by casting intensity {curr_max[i]} to maximum')
+            logging.info(f'Applying Gaussian filter of width {filter_width} to channel {i}')
+        return None
     for i in range(vNumChannels):
         # import pdb
         # pdb.set_trace()
@@ -151,6 +181,135 @@ def ApplyBeautification(vImarisApplication,filter_width,curr_max):
     return None
 
 
+def BeautifyChannels(vImage, vNumChannels, curr_max, sigmas):
+    '''Contrast-stretch and Gaussian-blur every channel, one channel per worker thread.
+
+    Each channel is read from Imaris once, stretched and blurred in memory, and
+    written back once. OpenCV releases the GIL while filtering, so channels are
+    processed concurrently. All transfers to and from Imaris stay on the
+    calling thread.
+    '''
+    storage_dtype = get_dtype_info(vImage)[0]
+    vShape = (vImage.GetSizeZ(), vImage.GetSizeY(), vImage.GetSizeX())
+    vChannelBytes = 3 * int(np.prod(vShape)) * np.dtype(storage_dtype).itemsize
+    workers = max(1, min(vNumChannels, os.cpu_count() or 1, CHANNEL_CACHE_BYTES // vChannelBytes))
+    # two working volumes per channel in flight, reused for every channel
+    working_buffers = [
+        (np.empty(vShape, dtype=storage_dtype), np.empty(vShape, dtype=storage_dtype))
+        for _ in range(workers)
+    ]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for t in range(vImage.GetSizeT()):
+            # Reading the next channel overlaps with processing the previous ones.
+            # At most `workers` channels are in flight, and the oldest is stored
+            # before another is read, so the channels held in memory stay within
+            # CHANNEL_CACHE_BYTES.
+            in_flight = deque()
+            for i in range(vNumChannels):
+                if len(in_flight) == workers:
+                    j, future = in_flight.popleft()
+                    store_channel_volume(vImage, future.result(), j, t)
+                in_flight.append((i, pool.submit(
+                    BeautifyVolume, load_channel_volume(vImage, i, t), *working_buffers[i % workers],
+                    curr_max[i], sigmas)))
+            for j, future in in_flight:
+                store_channel_volume(vImage, future.result(), j, t)
+
+
+def BeautifyVolume(volume, stretched, scratch, curr_max, sigmas):
+    '''Return a (Z, Y, X) volume contrast-stretched to curr_max and then blurred.
+
+    volume is only read. The result is written into either stretched or
+    scratch, which must have the same shape and dtype as volume.
+    '''
+    return GaussianBlur(StretchContrast(volume, curr_max, stretched), scratch, *sigmas)
+
+
+def StretchContrast(volume, curr_max, out):
+    '''Map intensities [0, curr_max] linearly onto [0, 255] into out, saturating above.
+
+    This matches IImageProcessing.ContrastStretchChannel(vImage, i, 0, curr_max, 0, 255).
+    Integer intensities are rounded to the nearest integer.
+    '''
+    alpha = 255.0 / curr_max
+    if np.issubdtype(volume.dtype, np.floating):
+        np.multiply(volume, alpha, out=out)
+        return np.clip(out, 0, 255, out=out)
+    # convertScaleAbs scales, rounds, and saturates to uint8 in one pass.
+    # Integer intensities are never negative, so taking the absolute value
+    # changes nothing.
+    if volume.dtype == np.uint8:
+        cv2.convertScaleAbs(
+            volume.reshape(-1, volume.shape[-1]), dst=out.reshape(-1, out.shape[-1]), alpha=alpha)
+        return out
+    # Wider integers are scaled one slice at a time through a uint8 slice
+    # rather than through a float copy of the whole volume.
+    stretched = np.empty(volume.shape[1:], dtype=np.uint8)
+    for z in range(volume.shape[0]):
+        cv2.convertScaleAbs(volume[z], dst=stretched, alpha=alpha)
+        out[z] = stretched
+    return out
+
+
+def GetVoxelSize(vImage):
+    '''Return the (x, y, z) size of a voxel in the image's real units.'''
+    return (
+        (vImage.GetExtendMaxX() - vImage.GetExtendMinX()) / vImage.GetSizeX(),
+        (vImage.GetExtendMaxY() - vImage.GetExtendMinY()) / vImage.GetSizeY(),
+        (vImage.GetExtendMaxZ() - vImage.GetExtendMinZ()) / vImage.GetSizeZ(),
+    )
+
+
+def GaussianBlur(volume, scratch, sigma_x, sigma_y, sigma_z):
+    '''Apply a 3D Gaussian filter to a (Z, Y, X) volume with OpenCV.
+
+    The filter is separable, so each slice is blurred in X and Y, and then the
+    whole volume is blurred along Z. Sigmas are in voxels. Along axes where
+    sigma is at least BOX_BLUR_MIN_SIGMA, the Gaussian is approximated by three
+    box filters, which cost the same per voxel regardless of sigma.
+
+    The passes alternate between volume and scratch instead of allocating new
+    volumes, so volume is overwritten. Returns whichever of the two holds the
+    blurred result.
+    '''
+    for z in range(volume.shape[0]):
+        if min(sigma_x, sigma_y) >= BOX_BLUR_MIN_SIGMA:
+            BoxBlur(volume[z], scratch[z], (BoxBlurWidth(sigma_x), BoxBlurWidth(sigma_y)))
+        else:
+            cv2.GaussianBlur(
+                volume[z], (0, 0), dst=scratch[z], sigmaX=sigma_x, sigmaY=sigma_y,
+                borderType=cv2.BORDER_REPLICATE)
+    if volume.shape[0] == 1:
+        return scratch
+    # Blurring the columns of a (Z, Y*X) view filters every voxel along Z.
+    columns = scratch.reshape(volume.shape[0], -1)
+    blurred = volume.reshape(volume.shape[0], -1)
+    if sigma_z >= BOX_BLUR_MIN_SIGMA:
+        BoxBlur(columns, blurred, (1, BoxBlurWidth(sigma_z)))
+    else:
+        kernel = cv2.getGaussianKernel(2 * int(np.ceil(3 * sigma_z)) + 1, sigma_z)
+        cv2.sepFilter2D(
+            columns, -1, np.ones(1), kernel, dst=blurred, borderType=cv2.BORDER_REPLICATE)
+    return volume
+
+
+def BoxBlurWidth(sigma):
+    '''Return the odd box width whose three-fold convolution has variance sigma**2.'''
+    # A box of width w has variance (w**2 - 1) / 12, and variances add.
+    return 2 * int(round((np.sqrt(4 * sigma ** 2 + 1) - 1) / 2)) + 1
+
+
+def BoxBlur(src, dst, ksize):
+    '''Approximate a Gaussian by applying a (width, height) box filter three times.
+
+    The passes alternate between src and dst, so the result is written into dst
+    and src is overwritten.
+    '''
+    cv2.boxFilter(src, -1, ksize, dst=dst, borderType=cv2.BORDER_REPLICATE)
+    cv2.boxFilter(dst, -1, ksize, dst=src, borderType=cv2.BORDER_REPLICATE)
+    cv2.boxFilter(src, -1, ksize, dst=dst, borderType=cv2.BORDER_REPLICATE)
+
+
 def Beautify(aImarisId):
     # Initialize and launch Tk window, then hide it.
     vRootTkWindow = tk.Tk()
@@ -158,6 +317,6 @@ def Beautify(aImarisId):
 
     try:
         Main(aImarisId)
-    except Exception as exception:
-        print(traceback.print_exception(type(exception), exception, exception.__traceback__))
+    except Exception:
+        traceback.print_exc()
     messagebox.showinfo('Complete', 'The XTension has terminated.')
@@ -34,11 +34,13 @@ try:
     from tkinter import messagebox
 
     from tqdm import tqdm
-    from tqdm.contrib.itertools import product
 
     import re
     import ast
     import operator
+    from concurrent.futures import ThreadPoolExecutor
+
+    from utils import MAX_TRANSFER_BYTES, get_dtype_info, get_slab_depth, load_channel, saturate_cast, store_channel
 except Exception as e:
     print(e)
     input("Press enter to exit;")
@@ -53,6 +55,35 @@ except Exception as e:
     batch_enabled=False
     input("Press enter to exit;")
 
+try:
+    import numexpr
+    numexpr_enabled=True
+except Exception as e:
+    print(e)
+    print('NumExpr unavailable; formulas will be evaluated one operator at a time.')
+    numexpr_enabled=False
+
+# Upper bound on the memory used to hold one slab of every channel that the
+# formulas read or write, so that each channel crosses the Imaris boundary once.
+CHANNEL_CACHE_BYTES = 1024 * 1024 * 1024
+
+# Voxels per block when a formula is evaluated with plain NumPy, so that the
+# temporaries of a few operands stay resident in L2 cache
+EVAL_BLOCK_VOXELS = 64 * 1024
+
+# Helpers available to compiled formulas, besides widen(), which casts to the
+# compute dtype of the image
+FORMULA_NAMESPACE = {
+    'array': np.array,
+    'maximum': np.maximum,
+    'minimum': np.minimum,
+    'logical_and': np.logical_and,
+    'logical_or': np.logical_or,
+}
+
+# Channel references in formulas, e.g. "ch3"; the group is the 1-based index
+CHANNEL_NAME_PATTERN = re.compile(r'ch(\d+)')
+
 # Define allowed operators 
 ALLOWED_OPERATORS = {
     ast.Add: (operator.add, "+"),
@@ -74,6 +105,75 @@ ALLOWED_FUNCTIONS = {
     'min': np.minimum,
 }
 
+class NumExprVisitor(ast.NodeVisitor):
+    '''Translates a formula into a single NumExpr expression.
+
+    NumExpr evaluates the whole expression in one blocked pass over the pixels,
+    instead of materializing a full-size temporary array for every operator.
+    '''
+
+    def visit_BinOp(self, node):
+        if type(node.op) not in ALLOWED_OPERATORS:
+            raise ValueError("Unsupported operator: {}".format(node.op))
+        symbol = ALLOWED_OPERATORS[type(node.op)][1]
+        return f"({self.visit(node.left)} {symbol} {self.visit(node.right)})"
+
+    def visit_Name(self, node):
+        if node.id.startswith("ch"):
+            return node.id
+        raise ValueError("Undefined variable: {}".format(node.id))
+
+    def visit_Call(self, node):
+        if not (isinstance(node.func, ast.Name) and node.func.id in ALLOWED_FUNCTIONS):
+            raise ValueError(f"Unsupported function: {node.func.id if isinstance(node.func, ast.Name) else 'unknown'}")
+        args = [self.visit(arg) for arg in node.args]
+        if len(args) < 2:
+            raise ValueError(f"Function {node.func.id} requires at least 2 arguments")
+        # NumExpr has no elementwise max/min, so express them with where().
+        symbol = '>' if node.func.id == 'max' else '<'
+        result = args[0]
+        for arg in args[1:]:
+            result = f"where({result} {symbol} {arg}, {result}, {arg})"
+        return result
+
+    def visit_Compare(self, node):
+        if len(node.ops) != 1 or len(node.comparators) != 1:
+            raise ValueError("Only simple comparisons are supported")
+        if type(node.ops[0]) not in ALLOWED_OPERATORS:
+            raise ValueError("Unsupported operator: {}".format(node.ops[0]))
+        symbol = ALLOWED_OPERATORS[type(node.ops[0])][1]
+        return f"({self.visit(node.left)} {symbol} {self.visit(node.comparators[0])})"
+
+    def visit_BoolOp(self, node):
+        if len(node.values) != 2:
+            raise ValueError("Can only perform BoolOp with two values")
+        # NumExpr only has bitwise &/|, so test truthiness explicitly to match
+        # np.logical_and/np.logical_or on non-boolean operands.
+        symbol = {ast.And: '&', ast.Or: '|'}.get(type(node.op))
+        if symbol is None:
+            raise ValueError("Unsupported operator: {}".format(node.op))
+        values0 = self.visit(node.values[0])
+        values1 = self.visit(node.values[1])
+        return f"(({values0} != 0) {symbol} ({values1} != 0))"
+
+    def visit_Num(self, node):
+        return self.format_number(node.n)
+
+    def visit_Constant(self, node):
+        return self.format_number(node.value)
+
+    def visit_Expr(self, node):
+        return self.visit(node.value)
+
+    @staticmethod
+    def format_number(value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError("Unsupported constant: {}".format(value))
+        return repr(value)
+
+    def generic_visit(self, node):
+        raise ValueError("Unsupported expression: {}".format(type(node).__name__))
+
 def get_formulas_from_user():
     import tkinter.scrolledtext as scrolledtext
     
@@ -191,178 +291,248 @@ def ChannelArithmetics(aImarisId):
 
 def RunChannelArithmetics(vImage, formulas, verbose=True): 
 
-    # Start with the original image
-    vImageCurrent = vImage.Clone()
-
-    # Process each formula sequentially
-    for i, formula_str in enumerate(formulas):
-        if verbose:
-            print(f"Processing formula {i+1}/{len(formulas)}: {formula_str}")
-        
-        # Apply the current formula
-        vImageCurrent = ApplyFormulaToImage(vImageCurrent, formula_str, verbose)
-    
-    return vImageCurrent
-
-
-# Map Imaris eType to numpy dtype info
-# storage_dtype: dtype matching the raw bytes from Imaris
-# compute_dtype: a wider dtype for intermediate arithmetic (avoids overflow)
-# clip_min/clip_max: valid value range (None for float types = no clipping)
-# method_suffix: suffix for Imaris GetDataSubSlice/SetDataSubSlice methods
-IMAGE_TYPE_MAP = {
-    'eTypeUInt8':  (np.uint8,   np.int16,    0, 255,   'Bytes'),
-    'eTypeUInt16': (np.uint16,  np.int32,    0, 65535,  'Shorts'),
-    'eTypeFloat':  (np.float32, np.float64,  None, None, 'Floats'),
-}
-
-def get_dtype_info(vImage):
-    """Query the Imaris image type and return (storage_dtype, compute_dtype, clip_min, clip_max, method_suffix)."""
-    type_str = str(vImage.GetType())
-    if type_str in IMAGE_TYPE_MAP:
-        return IMAGE_TYPE_MAP[type_str]
-    raise ValueError(f"Unsupported image type: {type_str}. Supported types: {list(IMAGE_TYPE_MAP.keys())}")
-
-
-def ApplyFormulaToImage(vImage, formula_str, verbose=True): 
-
     # Determine image data type
-    storage_dtype, compute_dtype, clip_min, clip_max, method_suffix = get_dtype_info(vImage)
+    dtype_info = get_dtype_info(vImage)
+    storage_dtype, compute_dtype, clip_min, clip_max, method_suffix = dtype_info
     if verbose:
         print(f"Image data type: {str(vImage.GetType())} -> numpy {storage_dtype.__name__}")
 
-    # Make a new image 
+    # Parse every formula and check the channels it reads before any data is
+    # moved. Formula i may read the original channels and the results of the
+    # formulas before it.
+    vNumChannels = vImage.GetSizeC()
+    parsed_formulas = []
+    for i, formula_str in enumerate(formulas):
+        if verbose:
+            print(f"Parsing formula {i+1}/{len(formulas)}: {formula_str}")
+        parsed_formula = ParseFormula(formula_str, verbose)
+        for ch_name, ch_index in parsed_formula[1].items():
+            if not 0 <= ch_index < vNumChannels + i:
+                raise ValueError(f"Formula {formula_str} uses {ch_name}, but only channels 1 to {vNumChannels + i} exist at that point")
+        parsed_formulas.append(parsed_formula)
+
+    # Clone the original image once and append one channel per formula to it
     vImageNew = vImage.Clone()
+    vImageNew.SetSizeC(vNumChannels + len(formulas))
+    for i, formula_str in enumerate(formulas):
+        if verbose:
+            print(f"Creating channel {vNumChannels + i + 1}, named {formula_str}")
+        vImageNew.SetChannelName(vNumChannels + i, formula_str)
 
-    # Get new channel index and name
-    ch_out_index = vImage.GetSizeC()
-    ch_out_name = formula_str
-    if verbose: 
-        print(f"Creating channel {ch_out_index + 1}, named {formula_str}")
-    vImageNew.SetSizeC(ch_out_index + 1)
-    vImageNew.SetChannelName(ch_out_index, ch_out_name)
-
-    # Get channel names and indices, e.g. {"ch3": 2, "ch12": 11}
-    channel_indices = {match: int(match[2:]) - 1 for match in re.findall(r'ch\d+', formula_str)}
-
-
-    # Define a class which can parse arithmetic expressions
-    class EvalVisitor(ast.NodeVisitor): 
-        
-        def visit_BinOp(self, node): 
-            left = self.visit(node.left)
-            right = self.visit(node.right)
-            if type(node.op) in ALLOWED_OPERATORS: 
-                return ALLOWED_OPERATORS[type(node.op)][0](left, right)
-            else: 
-                raise ValueError("Unsupported operator: {}".format(node.op))
-        
-        def visit_Name(self, node):
-            if node.id.startswith("ch") and node.id in channel_values: 
-                return np.array(channel_values[node.id])
-            raise ValueError("Undefined variable: {}".format(node.id))
-        
-        def visit_Call(self, node):
-            if isinstance(node.func, ast.Name) and node.func.id in ALLOWED_FUNCTIONS:
-                func = ALLOWED_FUNCTIONS[node.func.id]
-                args = [self.visit(arg) for arg in node.args]
-                if len(args) < 2:
-                    raise ValueError(f"Function {node.func.id} requires at least 2 arguments")
-                # For functions like max/min that take multiple arguments, apply iteratively
-                result = args[0]
-                for arg in args[1:]:
-                    result = func(result, arg)
-                return result
-            else:
-                raise ValueError(f"Unsupported function: {node.func.id if isinstance(node.func, ast.Name) else 'unknown'}")
-            
-        def visit_Compare(self, node):
-            left = self.visit(node.left)
-            if len(node.ops) != 1 or len(node.comparators) != 1: 
-                raise ValueError("Only simple comparisons are supported")
-            right = self.visit(node.comparators[0])
-            op_type = type(node.ops[0])
-            if op_type in ALLOWED_OPERATORS: 
-                return ALLOWED_OPERATORS[op_type][0](left, right)
-            else: 
-                raise ValueError("Undefined variable: {}".format(node.id))
-        
-        def visit_BoolOp(self, node):
-            if len(node.values) != 2: 
-                raise ValueError("Can only perform BoolOp with two values")
-            values0 = self.visit(node.values[0])
-            values1 = self.visit(node.values[1])
-            op_type = type(node.op)
-            if op_type in ALLOWED_OPERATORS: 
-                return ALLOWED_OPERATORS[op_type][0](values0, values1)
-            else: 
-                raise ValueError("Undefined variable: {}".format(node.id))
-        
-        def visit_Num(self, node): 
-            return np.array(node.n)
-
-        def visit_Constant(self, node): 
-            return np.array(node.value)
-        
-        def visit_Expr(self, node):
-            return self.visit(node.value)
-
-    # get channel values
-    channel_values = {} # start by initializing an empty dictionary
-
-    ### slice by slice operations originally developed by Eric in LinearUnmixing.py; modified for these purposes here
-    #process data slice by slice in square windows of length vWindowSize pixels
-    vWindowSize = 10000 # larger windows can speed up execution but will be more memory-intensive
+    #process data in slabs of whole Z slices, applying every formula to a slab
+    #before moving on so that each channel is read from Imaris only once
     vNumSlices = vImage.GetSizeZ()
     vXSize = vImage.GetSizeX()
     vYSize=vImage.GetSizeY()
     vNumTimepoints = vImage.GetSizeT()
+    cached_channels = {ch_index for _, channel_indices, _ in parsed_formulas for ch_index in channel_indices.values()}
+    input_channels = sorted(ch_index for ch_index in cached_channels if ch_index < vNumChannels)
+    cached_channels.update(range(vNumChannels, vNumChannels + len(formulas)))
+    # the next slab of every input channel is prefetched while this one is processed
+    vNumCachedSlabs = len(cached_channels) + len(input_channels)
+    vSlabDepth = get_slab_depth(vXSize, vYSize, vNumSlices, storage_dtype,
+                                min(MAX_TRANSFER_BYTES, CHANNEL_CACHE_BYTES // vNumCachedSlabs))
+    slabs = [(t, z) for t in range(vNumTimepoints) for z in range(0, vNumSlices, vSlabDepth)]
+
+    def read_slab(t, z):
+        slab_shape = (min(vSlabDepth,vNumSlices-z), vYSize, vXSize)
+        return {ch_index: load_channel(vImageNew, ch_index, t, z, slab_shape, storage_dtype, method_suffix)
+                for ch_index in input_channels}
+
+    # one output buffer per formula, reused for every slab instead of
+    # allocating (and page-faulting) a fresh slab-sized array each time
+    result_buffers = [np.empty((vSlabDepth, vYSize, vXSize), dtype=storage_dtype) for _ in formulas]
+
+    warn_clipping_max = [True] * len(formulas)
+    warn_clipping_min = [True] * len(formulas)
+    # Reads run on a background thread, overlapping Imaris I/O of the next slab
+    # with computing the current one. Writes stay on this thread.
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        next_slab = reader.submit(read_slab, *slabs[0])
+        for k, (t, z) in enumerate(tqdm(slabs, desc="Slabs")):
+            slab_shape = (min(vSlabDepth,vNumSlices-z), vYSize, vXSize)
+
+            # slabs of every channel read or computed so far, by channel index
+            channel_cache = next_slab.result()
+            if k + 1 < len(slabs):
+                next_slab = reader.submit(read_slab, *slabs[k + 1])
+            ApplyFormulasToSlab(vImageNew, parsed_formulas, formulas, channel_cache, result_buffers, t, z, slab_shape,
+                                vNumChannels, dtype_info, warn_clipping_min, warn_clipping_max)
+
+    return vImageNew
+
 
-    is_first = True
-    warn_clipping_max = True
-    warn_clipping_min = True
-    for t,x,y,z in product(range(vNumTimepoints),range(0,vXSize,vWindowSize),range(0,vYSize,vWindowSize),range(vNumSlices)):
-        window_x_len=min(vWindowSize,vXSize-x)
-        window_y_len=min(vWindowSize,vYSize-y)
-
-        for ch_name in channel_indices:
-            channel_values[ch_name] = np.zeros((window_x_len,window_y_len))
-            ch_index = channel_indices[ch_name]
-            get_sub_slice = getattr(vImage, f'GetDataSubSlice{method_suffix}')
-            raw_data = get_sub_slice(aIndexX=x,aIndexY=y,aIndexZ=z,aIndexC=ch_index,aIndexT=t,aSizeX=window_x_len,aSizeY=window_y_len)
-            if method_suffix == 'Bytes':
-                channel_values[ch_name] = np.array([np.frombuffer(row, dtype=storage_dtype) for row in raw_data], dtype=compute_dtype)
-            else:
-                channel_values[ch_name] = np.array(raw_data, dtype=compute_dtype)
-
-        # parse arithmetic expression
-        tree = ast.parse(formula_str, mode='eval')
-        if is_first and verbose: 
-            print("\n")
-            print(ast.dump(ast.parse(formula_str)))
-            print("\n")
-            is_first = False
+def ApplyFormulasToSlab(vImage, parsed_formulas, formulas, channel_cache, result_buffers, t, z, slab_shape,
+                        vNumChannels, dtype_info, warn_clipping_min, warn_clipping_max):
+    """Evaluate every formula on one slab and write each result to its new channel.
+
+    channel_cache holds this slab of every original channel the formulas read.
+    Results are added to it so that later formulas can use them without a
+    round trip; RunChannelArithmetics has already checked that each formula
+    only reads channels that are in the cache by the time it runs.
+    result_buffers[i] is overwritten with the result of formula i.
+    """
+    storage_dtype, compute_dtype, clip_min, clip_max, method_suffix = dtype_info
+    for i, (compiled_formula, channel_indices, numexpr_formula) in enumerate(parsed_formulas):
+        ch_out_index = vNumChannels + i
+
+        # get channel values
+        channel_values = {ch_name: channel_cache[ch_index] for ch_name, ch_index in channel_indices.items()}
 
         # calculate
-        new_channel_values = EvalVisitor().visit(tree.body)
-
-        # Clip and convert to the storage dtype
-        if clip_min is not None and clip_max is not None:
-            if warn_clipping_max and np.any(new_channel_values > clip_max):
-                print(f"\nWarning: Some values are above {clip_max}, clipping to {clip_max}.\n")
-                warn_clipping_max = False
-            if warn_clipping_min and np.any(new_channel_values < clip_min):
-                print(f"\nWarning: Some values are below {clip_min}, clipping to {clip_min}.\n")
-                warn_clipping_min = False
-            new_channel_values = np.clip(new_channel_values, clip_min, clip_max)
-        new_channel_values = np.array(new_channel_values, dtype=storage_dtype)
-        
-        # Add data to new channel in new Image
-        set_sub_slice = getattr(vImageNew, f'SetDataSubSlice{method_suffix}')
-        if method_suffix == 'Bytes':
-            out_data = [row.tobytes() for row in new_channel_values]
+        if numexpr_formula is not None:
+            new_channel_values = numexpr.evaluate(numexpr_formula, local_dict=channel_values)
         else:
-            out_data = [row.tolist() for row in new_channel_values]
-        set_sub_slice(aData=out_data,aIndexX=x,aIndexY=y,aIndexZ=z,aIndexC=ch_out_index,aIndexT=t)
+            new_channel_values = EvaluateInBlocks(compiled_formula, channel_values, compute_dtype)
+
+        # Clip and convert to the storage dtype, checking the value range
+        # only until both warnings have been shown. Boolean results (from
+        # comparisons and and/or) are 0/1 and never need clipping.
+        is_mask = new_channel_values.dtype == np.bool_
+        if clip_min is not None and clip_max is not None and not is_mask and (warn_clipping_max[i] or warn_clipping_min[i]):
+            values_min, values_max = new_channel_values.min(), new_channel_values.max()
+            if warn_clipping_max[i] and values_max > clip_max:
+                print(f"\nWarning: Some values of {formulas[i]} are above {clip_max}, clipping to {clip_max}.\n")
+                warn_clipping_max[i] = False
+            if warn_clipping_min[i] and values_min < clip_min:
+                print(f"\nWarning: Some values of {formulas[i]} are below {clip_min}, clipping to {clip_min}.\n")
+                warn_clipping_min[i] = False
+        new_channel_values = saturate_cast(new_channel_values, storage_dtype, clip_min, clip_max,
+                                           out=result_buffers[i][:slab_shape[0]])
+
+        # Add data to new channel in new Image, and keep it for later formulas
+        store_channel(vImage, new_channel_values, ch_out_index, t, z, method_suffix)
+        channel_cache[ch_out_index] = new_channel_values
+
+
+def EvaluateInBlocks(compiled_formula, channel_values, compute_dtype):
+    """Evaluate a compiled formula with NumPy over cache-sized blocks of a slab.
+
+    Evaluating a whole slab at once streams every intermediate array through
+    main memory. Blocks of EVAL_BLOCK_VOXELS keep the temporaries in cache.
+    NumExpr does the same blocking internally.
+    """
+    namespace = dict(FORMULA_NAMESPACE, __builtins__={},
+                     widen=lambda values: values.astype(compute_dtype, copy=False))
+    if not channel_values:
+        return eval(compiled_formula, namespace, channel_values)
+    slab_shape = next(iter(channel_values.values())).shape
+    flat_values = {ch_name: values.reshape(-1) for ch_name, values in channel_values.items()}
+    num_voxels = int(np.prod(slab_shape))
+    result = None
+    for start in range(0, num_voxels, EVAL_BLOCK_VOXELS):
+        block = slice(start, start + EVAL_BLOCK_VOXELS)
+        block_values = {ch_name: values[block] for ch_name, values in flat_values.items()}
+        block_result = eval(compiled_formula, namespace, block_values)
+        if result is None:
+            result = np.empty(num_voxels, dtype=block_result.dtype)
+        result[block] = block_result
+    return result.reshape(slab_shape)
+
+
+def ParseFormula(formula_str, verbose=True):
+    """Parse a formula once and return (compiled_formula, channel_indices, numexpr_formula).
+
+    numexpr_formula is None when NumExpr is unavailable, in which case
+    compiled_formula is evaluated with EvaluateInBlocks.
+    """
+    # Get channel names and indices, e.g. {"ch3": 2, "ch12": 11}
+    channel_indices = {f'ch{n}': int(n) - 1 for n in CHANNEL_NAME_PATTERN.findall(formula_str)}
 
-    return vImageNew
+    # parse arithmetic expression
+    tree = ast.parse(formula_str, mode='eval')
+    if verbose: 
+        print("\n")
+        print(ast.dump(tree))
+        print("\n")
+
+    # Validate the formula and compile it for the NumPy fallback
+    compiled_formula = CompileFormula(tree)
+
+    # Fuse the whole formula into one NumExpr pass when NumExpr is available
+    numexpr_formula = None
+    if numexpr_enabled:
+        numexpr_formula = NumExprVisitor().visit(tree.body)
+        if verbose:
+            print(f"Evaluating with NumExpr: {numexpr_formula}")
+
+    return compiled_formula, channel_indices, numexpr_formula
+
+
+class FormulaCompiler(ast.NodeTransformer):
+    '''Validates a formula and rewrites it into a plain expression over NumPy arrays.
+
+    The rewritten tree is compiled once and run with eval() on every block,
+    instead of walking the tree again for each block of each slab. It only
+    calls the helpers in FORMULA_NAMESPACE and the channels it reads.
+    '''
+
+    def visit_BinOp(self, node):
+        if type(node.op) not in ALLOWED_OPERATORS:
+            raise ValueError("Unsupported operator: {}".format(node.op))
+        # Channels are loaded in their storage dtype; widen only here,
+        # where +, -, and * could overflow it. Both operands are widened:
+        # NumPy 1.x treats a 0-d array like a scalar when promoting, so a
+        # widened constant alone would leave e.g. 2 * ch1 in uint8.
+        left = self.call('widen', [self.visit(node.left)])
+        right = self.call('widen', [self.visit(node.right)])
+        return ast.BinOp(left=left, op=node.op, right=right)
+
+    def visit_Name(self, node):
+        if CHANNEL_NAME_PATTERN.fullmatch(node.id):
+            return ast.Name(id=node.id, ctx=ast.Load())
+        raise ValueError("Undefined variable: {}".format(node.id))
+
+    def visit_Call(self, node):
+        if not (isinstance(node.func, ast.Name) and node.func.id in ALLOWED_FUNCTIONS):
+            raise ValueError(f"Unsupported function: {node.func.id if isinstance(node.func, ast.Name) else 'unknown'}")
+        args = [self.visit(arg) for arg in node.args]
+        if len(args) < 2:
+            raise ValueError(f"Function {node.func.id} requires at least 2 arguments")
+        # For functions like max/min that take multiple arguments, apply iteratively
+        func_name = ALLOWED_FUNCTIONS[node.func.id].__name__
+        result = args[0]
+        for arg in args[1:]:
+            result = self.call(func_name, [result, arg])
+        return result
+
+    def visit_Compare(self, node):
+        if len(node.ops) != 1 or len(node.comparators) != 1:
+            raise ValueError("Only simple comparisons are supported")
+        if type(node.ops[0]) not in ALLOWED_OPERATORS:
+            raise ValueError("Unsupported operator: {}".format(node.ops[0]))
+        return ast.Compare(left=self.visit(node.left), ops=node.ops, comparators=[self.visit(node.comparators[0])])
+
+    def visit_BoolOp(self, node):
+        if len(node.values) != 2:
+            raise ValueError("Can only perform BoolOp with two values")
+        if type(node.op) not in ALLOWED_OPERATORS:
+            raise ValueError("Unsupported operator: {}".format(node.op))
+        # and/or do not work elementwise on arrays, so call the NumPy ufunc.
+        func_name = ALLOWED_OPERATORS[type(node.op)][0].__name__
+        return self.call(func_name, [self.visit(value) for value in node.values])
+
+    def visit_Num(self, node):
+        return self.constant(node.n)
+
+    def visit_Constant(self, node):
+        return self.constant(node.value)
+
+    def generic_visit(self, node):
+        raise ValueError("Unsupported expression: {}".format(type(node).__name__))
+
+    def constant(self, value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError("Unsupported constant: {}".format(value))
+        # Wrap numbers in arrays so they promote with channels as they always have.
+        return self.call('array', [ast.Constant(value=value)])
+
+    @staticmethod
+    def call(func_name, args):
+        return ast.Call(func=ast.Name(id=func_name, ctx=ast.Load()), args=args, keywords=[])
+
+
+def CompileFormula(tree):
+    """Validate a parsed formula and compile it for EvaluateInBlocks."""
+    body = FormulaCompiler().visit(tree.body)
+    return compile(ast.fix_missing_locations(ast.Expression(body=body)), '<formula>', 'eval')
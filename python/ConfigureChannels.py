@@ -54,6 +54,7 @@ try:
     from tkinter import *
     from tkinter import messagebox
     from tkinter import filedialog
+    from utils import log_to_file
 except Exception as e:
     print(e)
     input("Press enter to exit;")
@@ -61,6 +62,7 @@ except Exception as e:
 
 
 EXPECTED_HEADER = ['channel', 'setting', 'fluorophore', 'target', 'color']
+PANEL_READ_BUFFER_BYTES = 1024 * 1024
 LOG_FORMAT = '%(asctime)s %(levelname)s [%(pathname)s:%(lineno)d %(name)s] %(message)s'
 
 def Main(aImarisId):
@@ -80,41 +82,46 @@ def Main(aImarisId):
     image_path = vImarisApplication.GetCurrentFileName()
     logpath = image_path + '.log'
     
-    logging.basicConfig(format=LOG_FORMAT, filename=logpath, level=logging.INFO)
-    logging.info('----- Begin Editing %s -----', image_path)
+    with log_to_file(logpath, LOG_FORMAT):
+        logging.info('----- Begin Editing %s -----', image_path)
 
 
 
-    logging.info('Asking user to select panel')
-    with filedialog.askopenfile(mode='r', title='Select CSV specifying renaming panel') as f:
-        vNewChannelNames,vNewChannelColors=read_panel_csv(f)
-        panel_file_path=f.name
-    batched=messagebox.askyesno(
-        'Batched Operation.',
-        'Would you like to apply changes to all .ims files in this folder?'
-    )
-
-
-    if batched:
-        XTBatch(vImarisApplication,ConfigureImageChannels,(vNewChannelNames,vNewChannelColors,True))
-    else:
-        # Get the image and channels
-        vNumberOfImages = vImarisApplication.GetNumberOfImages()
-        if vNumberOfImages != 1:
-            messagebox.showwarning('Only 1 image may be open at a time for this XTension')
+        logging.info('Asking user to select panel')
+        panel_file_path = filedialog.askopenfilename(title='Select CSV specifying renaming panel')
+        if not panel_file_path:
+            logging.info('User canceled panel selection.')
             return
-
-        vImage = vImarisApplication.GetImage(0)
-        vImageNew=ConfigureImageChannels(vImage,vNewChannelNames,vNewChannelColors)
-        vImarisApplication.SetImage(0, vImageNew)
-        logging.info('Asking user to save image.')
-        saved = messagebox.askyesno(
-            'Save changes.',
-            'Please save or discard changes. Did you save the file?'
+        # Open the panel the way the csv module expects (newline='') and read
+        # it in one large buffer rather than the default small reads.
+        with open(panel_file_path, newline='', buffering=PANEL_READ_BUFFER_BYTES) as f:
+            vNewChannelNames,vNewChannelColors=read_panel_csv(f)
+        batched=messagebox.askyesno(
+            'Batched Operation.',
+            'Would you like to apply changes to all .ims files in this folder?'
         )
-        logging.info('User reports that they saved changes: %s', saved)
-        logging.info('----- Done Editing %s -----', image_path)
-    print('Changes complete.')
+
+
+        if batched:
+            XTBatch(vImarisApplication,ConfigureImageChannels,(vNewChannelNames,vNewChannelColors,True))
+        else:
+            # Get the image and channels
+            vNumberOfImages = vImarisApplication.GetNumberOfImages()
+            if vNumberOfImages != 1:
+                messagebox.showwarning('Only 1 image may be open at a time for this XTension')
+                return
+
+            vImage = vImarisApplication.GetImage(0)
+            vImageNew=ConfigureImageChannels(vImage,vNewChannelNames,vNewChannelColors)
+            vImarisApplication.SetImage(0, vImageNew)
+            logging.info('Asking user to save image.')
+            saved = messagebox.askyesno(
+                'Save changes.',
+                'Please save or discard changes. Did you save the file?'
+            )
+            logging.info('User reports that they saved changes: %s', saved)
+            logging.info('----- Done Editing %s -----', image_path)
+        print('Changes complete.')
 
 # def configure_channels(vImage,vNewChannelNames=None,vNewChannelColors=None,panel_file_path=None,confirmed=False):
 #     vNumChannels = vImage.GetSizeC()
@@ -169,10 +176,14 @@ def Main(aImarisId):
 def ConfigureImageChannels(vImage,vNewChannelNames,vNewChannelColors,confirmed=False):
 
     vNumChannels = vImage.GetSizeC()
-    vOldChannelNames = [vImage.GetChannelName(i) for i in range(vNumChannels)]
-    vOldChannelColors = [vImage.GetChannelColorRGBA(i) for i in range(vNumChannels)]
-    vOldChannelColorStrings = ['%08x' % color for color in vOldChannelColors]
-    vNewChannelColorStrings = ['%08x' % color for color in vNewChannelColors]
+    # Imaris has no bulk getter for channel names or colors either, so read both in one pass.
+    vOldChannelNames = []
+    vOldChannelColors = []
+    for i in range(vNumChannels):
+        vOldChannelNames.append(vImage.GetChannelName(i))
+        vOldChannelColors.append(vImage.GetChannelColorRGBA(i))
+    vOldChannelColorStrings = [f'{color:08x}' for color in vOldChannelColors]
+    vNewChannelColorStrings = [f'{color:08x}' for color in vNewChannelColors]
     if len(vOldChannelNames) != len(vNewChannelNames):
         raise RuntimeError(
             f'Old channels {vOldChannelNames} and new channels '
@@ -199,16 +210,17 @@ def ConfigureImageChannels(vImage,vNewChannelNames,vNewChannelColors,confirmed=F
     else:
         print('Changes aborted.')
         return None
-    vImageNew=vImage.Clone()
     logging.info('Renaming channels from %s to %s.', vOldChannelNames, vNewChannelNames)
-    for i, vNewName in enumerate(vNewChannelNames):
-        vImageNew.SetChannelName(i, vNewName)
-    logging.info('Channel renaming complete.')
     logging.info('Re-coloring channels from %s to %s', vOldChannelColorStrings, vNewChannelColorStrings)
-    for i, vNewColor in enumerate(vNewChannelColors):
-        vImageNew.SetChannelColorRGBA(i, vNewColor)
+    # Names and colors are metadata, so they are set on the image itself rather
+    # than on a clone, which would copy every voxel just to change a few strings.
+    # Imaris has no bulk setter for channel names or colors, so set both in one pass.
+    for i, (vNewName, vNewColor) in enumerate(zip(vNewChannelNames, vNewChannelColors)):
+        vImage.SetChannelName(i, vNewName)
+        vImage.SetChannelColorRGBA(i, vNewColor)
+    logging.info('Channel renaming complete.')
     logging.info('Channel re-coloring complete.')
-    return vImageNew
+    return vImage
 
 
 def read_panel_csv(f):
@@ -227,13 +239,11 @@ def read_panel_csv(f):
             raise RuntimeError(f'Invalid color for {fluorophore} {target}: {rgb}')
             return
         vNewChannelNames.append(f'{target} {fluorophore}')
-        # The CSV specifies color as RGB
-        red = rgb[0:2]
-        green = rgb[2:4]
-        blue = rgb[4:6]
-        # The color is represented as ABGR where each of alpha, blue, green, and red are represented by
-        # a byte and A is the most-significant byte. We set an opacity of 0, which indicates no transparency.
-        vNewChannelColors.append(int(f'00{blue}{green}{red}', 16))
+        # The CSV specifies color as RGB, but the color is represented as ABGR where each of alpha,
+        # blue, green, and red are represented by a byte and A is the most-significant byte. Reading
+        # the RGB bytes as a little-endian integer puts red in the least-significant byte and leaves
+        # an opacity of 0, which indicates no transparency.
+        vNewChannelColors.append(int.from_bytes(bytes.fromhex(rgb), 'little'))
     return vNewChannelNames,vNewChannelColors
 
 def ConfigureChannels(aImarisId):
@@ -243,6 +253,6 @@ def ConfigureChannels(aImarisId):
 
     try:
         Main(aImarisId)
-    except Exception as exception:
-        print(traceback.print_exception(type(exception), exception, exception.__traceback__))
+    except Exception:
+        traceback.print_exc()
     messagebox.showinfo('Complete', 'The XTension has terminated.')
@@ -8,9 +8,16 @@ sys.path.append("C:\\Program Files\\Bitplane\\Imaris 10.2.0\\XT\\python3")
 
 import ImarisLib
 
+# The ImarisLib connection and server proxy are created once and reused, since
+# each new ImarisLib sets up its own Ice communicator.
+vImarisLib = None
+vServer = None
+
 def GetServer():
-    vImarisLib = ImarisLib.ImarisLib()
-    vServer = vImarisLib.GetServer()
+    global vImarisLib, vServer
+    if vServer is None:
+        vImarisLib = ImarisLib.ImarisLib()
+        vServer = vImarisLib.GetServer()
     return vServer;
 
 def GetObjectId():
@@ -146,6 +146,6 @@ def DilateSurface(aImarisId):
 
     try:
         Main(vImarisApplication)
-    except Exception as exception:
-        print(traceback.print_exception(type(exception), exception, exception.__traceback__))
+    except Exception:
+        traceback.print_exc()
     messagebox.showinfo('Complete', 'The XTension has terminated.')
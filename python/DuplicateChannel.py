@@ -29,7 +29,8 @@ try:
     import tkinter as tk
     import traceback
     from tqdm import tqdm
-    from tqdm.contrib.itertools import product
+
+    from utils import get_dtype_info
 except Exception as e:
     print(e)
     input("Press enter to exit;")
@@ -44,6 +45,10 @@ except Exception as e:
     batch_enabled=False
     input("Press enter to exit;")
 
+# Bytes of one channel copied per Imaris call. Windows span whole rows, so
+# each call moves a contiguous band of a slice.
+WINDOW_BYTES = 64 * 1024 * 1024
+
 
 def DuplicateChannel(aImarisId):
     # Create an ImarisLib object
@@ -63,8 +68,9 @@ def DuplicateChannel(aImarisId):
     vImage = vImarisApplication.GetImage(0)
     nChannels = vImage.GetSizeC()
     channel_list = range(1, nChannels + 1)
-    channel_names = [f"{ch}: {vImage.GetChannelName(ch - 1)}" for ch in channel_list]
-    nTime = vImage.GetSizeT()
+    # Look each name up once; every GetChannelName call is a round trip to Imaris
+    vChannelNames = [vImage.GetChannelName(ch - 1) for ch in channel_list]
+    channel_names = [f"{ch}: {name}" for ch, name in zip(channel_list, vChannelNames)]
 
     # Select channels
     channels_selected = create_window_from_list(channel_list, window_title="Select channels:", display_names=channel_names)
@@ -73,7 +79,7 @@ def DuplicateChannel(aImarisId):
         return
 
     channels_selected = [np.int64(ch) for ch in channels_selected]
-    selected_channel_names = [vImage.GetChannelName(ch - 1) for ch in channels_selected]
+    selected_channel_names = [vChannelNames[ch - 1] for ch in channels_selected]
     print(f'Selected channels: {selected_channel_names}')
 
     if batch_enabled:
@@ -107,13 +113,22 @@ def DuplicateChannel(aImarisId):
 
 
 def RunDuplicateChannel(vImage, channels_selected, verbose=True): 
-    # Get channels
+    # Get the image metadata once; each query is a round trip to Imaris
     nChannels = vImage.GetSizeC()
-    nTime = vImage.GetSizeT()
+    vNumSlices = vImage.GetSizeZ()
+    vXSize = vImage.GetSizeX()
+    vYSize = vImage.GetSizeY()
+    storage_dtype, _, _, _, method_suffix = get_dtype_info(vImage)
 
     vImageNew = vImage.Clone()
     vImageNew.SetSizeC(nChannels + len(channels_selected))
 
+    # Process data slice by slice, in bands of whole rows of at most WINDOW_BYTES
+    get_sub_slice = getattr(vImage, f'GetDataSubSlice{method_suffix}')
+    set_sub_slice = getattr(vImageNew, f'SetDataSubSlice{method_suffix}')
+    vWindowYSize = max(1, min(vYSize, WINDOW_BYTES // (vXSize * np.dtype(storage_dtype).itemsize)))
+    vWindowYStarts = range(0, vYSize, vWindowYSize)
+
     for ch_in in channels_selected:
         ch_in_name = vImage.GetChannelName(ch_in - 1)
         ch_out = nChannels + 1
@@ -121,25 +136,20 @@ def RunDuplicateChannel(vImage, channels_selected, verbose=True):
 
         vImageNew.SetChannelName(ch_out - 1, ch_out_name)
 
-        # Process data slice by slice
-        vWindowSize = 10000
-        vNumSlices = vImage.GetSizeZ()
-        vXSize = vImage.GetSizeX()
-        vYSize = vImage.GetSizeY()
-        
+        # The color table is the same for every window, so copy it once
+        data_channel_colortable = vImage.GetChannelColorTable(aIndexC=ch_in - 1)
+        vImageNew.SetChannelColorTable(ch_out - 1, data_channel_colortable.mColorRGB, data_channel_colortable.mAlpha)
+
         if verbose: 
             print(f"Duplicating channel {ch_in_name}...")
-        for x, y, z in product(range(0, vXSize, vWindowSize), range(0, vYSize, vWindowSize), range(vNumSlices)):
-            window_x_len = min(vWindowSize, vXSize - x)
-            window_y_len = min(vWindowSize, vYSize - y)
-            vImageArray = np.zeros((window_x_len, window_y_len))
-
-            vImageArray = np.array([np.frombuffer(row, dtype=np.uint8) for row in vImage.GetDataSubSliceBytes(
-                aIndexX=x, aIndexY=y, aIndexZ=z, aIndexC=ch_in - 1, aIndexT=0, aSizeX=window_x_len, aSizeY=window_y_len)])
-            data_channel_colortable = vImage.GetChannelColorTable(aIndexC=ch_in - 1)
-            
-            vImageNew.SetDataSubSliceBytes(aData=[row.tobytes() for row in vImageArray], aIndexX=x, aIndexY=y, aIndexZ=z, aIndexC=ch_out - 1, aIndexT=0)
-            vImageNew.SetChannelColorTable(ch_out - 1, data_channel_colortable.mColorRGB, data_channel_colortable.mAlpha)
+        # Walk the volume slice by slice, the order Imaris stores it in
+        for z in tqdm(range(vNumSlices)):
+            for y in vWindowYStarts:
+                window_y_len = min(vWindowYSize, vYSize - y)
+                # The data is copied unchanged, so pass the rows straight through
+                vRows = get_sub_slice(
+                    aIndexX=0, aIndexY=y, aIndexZ=z, aIndexC=ch_in - 1, aIndexT=0, aSizeX=vXSize, aSizeY=window_y_len)
+                set_sub_slice(aData=vRows, aIndexX=0, aIndexY=y, aIndexZ=z, aIndexC=ch_out - 1, aIndexT=0)
 
         nChannels += 1
 
@@ -152,7 +162,7 @@ def create_window_from_list(object_list, window_title='Select one or more', w=50
     """
     Create a selection window from provided list with multiple selection capability.
 
-    :param object_list: List to create a checkbox selector
+    :param object_list: List to create a selector from
     :param window_title: Window title
     :param w: width of the window, default = 500
     :param h: height of the window, default = 800
@@ -167,9 +177,7 @@ def create_window_from_list(object_list, window_title='Select one or more', w=50
     canceled = False
 
     def on_selection_complete():
-        for var, item in zip(checkbox_vars, object_list):
-            if var.get():
-                selected_items.append(item)
+        selected_items.extend(object_list[i] for i in listbox.curselection())
         window.destroy()
 
     def on_cancel():
@@ -177,10 +185,10 @@ def create_window_from_list(object_list, window_title='Select one or more', w=50
         canceled = True
         window.destroy()
 
-    checkbox_vars = [tk.BooleanVar() for _ in object_list]
-    for var, item, display_name in zip(checkbox_vars, object_list, display_names or object_list):
-        checkbox = tk.Checkbutton(window, text=display_name, variable=var, anchor="w", justify="left")
-        checkbox.pack(fill="x", anchor="w")
+    # A single Listbox scales to many channels, unlike one Checkbutton per item
+    listbox = tk.Listbox(window, selectmode=tk.MULTIPLE, exportselection=False)
+    listbox.insert(tk.END, *(display_names or object_list))
+    listbox.pack(fill="both", expand=True)
 
     closing_button = tk.Button(master=window, text='Selection Complete', command=on_selection_complete)
     closing_button.pack()
@@ -16,6 +16,8 @@
 '''ExportSurfaces exports the surfaces in an Imaris file for use outside Imaris.
 '''
 
+import base64
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import logging
 import os
@@ -29,7 +31,7 @@ from tkinter import Tk
 from tkinter import messagebox
 from tkinter import filedialog
 from tkinter import simpledialog
-from tqdm import tqdm
+from tqdm import trange
 
 # Some DLLs that numpy needs are stored at this path, but it isn't correctly
 # set by default. We can't just set the system environment variable because
@@ -41,100 +43,147 @@ os.environ['PATH'] += f';{DLL_PATH}'
 
 import numpy as np
 
+from utils import log_to_file
+
 LOG_FORMAT = '%(asctime)s %(levelname)s [%(pathname)s:%(lineno)d %(name)s] %(message)s'
 SURFACE_SERIALIZATION_SPEC_VERSION = "0.1.0"
+# Binary masks replace the nested int16 list in "mask" with a base64 string and
+# add "maskShape" and "maskEncoding", so exports using them get their own version.
+BINARY_MASK_SERIALIZATION_SPEC_VERSION = "0.2.0"
+
+def GetSurfaceJson(vSurfaces, vSurfaceIndex, vSurfaceId, vBinaryMask=False):
+    '''Retrieve a Surface's JSON data.
+
+    With vBinaryMask, the mask is binarized on sign and bit-packed instead of
+    exported at full precision.'''
+    vSurfaceData = vSurfaces.GetSurfaceData(vSurfaceIndex)
+    assert str(vSurfaceData.GetType()) == 'eTypeUInt16'
+    # The mask has a single channel and time point. Fetch it as 16-bit
+    # shorts, its native width, rather than as floats. The mask is
+    # signed, so cast rather than construct with int16 directly in case
+    # values come back in the unsigned range (e.g. 32768 for -32768).
+    assert vSurfaceData.GetSizeC() == 1
+    assert vSurfaceData.GetSizeT() == 1
+    vSurfaceDataArray = np.asarray(vSurfaceData.GetDataVolumeAs1DArrayShorts(0, 0)).astype(np.int16, copy=False)
+    # The 1D array has x varying fastest, so a C-order reshape gives axes
+    # (z, y, x) without a transposed copy.
+    vSurfaceDataArray = vSurfaceDataArray.reshape(
+        vSurfaceData.GetSizeZ(), vSurfaceData.GetSizeY(), vSurfaceData.GetSizeX())
+
+    aSurfaceJson = {
+        'id': vSurfaceId,
+        # xRange, yRange, and zRange define the ranges of x, y, and z
+        # coordinates spanned by the bounding box filled by the mask.
+        'xRange': [vSurfaceData.GetExtendMinX(), vSurfaceData.GetExtendMaxX()],
+        'yRange': [vSurfaceData.GetExtendMinY(), vSurfaceData.GetExtendMaxY()],
+        'zRange': [vSurfaceData.GetExtendMinZ(), vSurfaceData.GetExtendMaxZ()],
+        # The mask contains positive values inside the surface and negative
+        # values outside the surface. To identify the precise boundary of
+        # the surface, interpolate between the positive and negative values
+        # to find the zero point. Alternatively, for an approximate mask,
+        # binarize on the sign of each voxel. Mask dimensions are (z, y, x).
+        'mask': vSurfaceDataArray,
+    }
+    if vBinaryMask:
+        # Pack the sign of each voxel into bits, 8 voxels per byte in (z, y, x)
+        # order, matching ExportSurfacesBinary. JSON has no bytes type, so the
+        # packed bits are stored as a base64 string.
+        aSurfaceJson['maskShape'] = list(vSurfaceDataArray.shape)
+        aSurfaceJson['maskEncoding'] = 'packbits-base64'
+        aSurfaceJson['mask'] = base64.b64encode(
+            np.packbits(vSurfaceDataArray.ravel() > 0, bitorder='big')).decode('ascii')
+    return aSurfaceJson
+
 
 def Main(vImarisApplication):
     image_path = vImarisApplication.GetCurrentFileName()
     logpath = image_path + '.log'
-    logging.basicConfig(format=LOG_FORMAT, filename=logpath, level=logging.INFO)
-    logging.info('----- Begin exporting surfaces from %s -----', image_path)
-
-    # Get the image and channels
-    vNumberOfImages = vImarisApplication.GetNumberOfImages()
-    if vNumberOfImages != 1:
-        messagebox.showwarning('Only 1 image may be open at a time for this XTension')
-        return
+    with log_to_file(logpath, LOG_FORMAT):
+        logging.info('----- Begin exporting surfaces from %s -----', image_path)
 
-    vSurfaces = vImarisApplication.GetFactory().ToSurfaces(vImarisApplication.GetSurpassSelection())
-    logging.info('Selected set of surfaces: %s', vSurfaces.GetName())
-    vNumSelected = len(vSurfaces.GetSelectedIndices())
-    vSelectionMode = messagebox.askyesnocancel(
-        'Surfaces Selection', 
-        f'Export only the {vNumSelected} selected surfaces? Choose "No" to export all surfaces in "{vSurfaces.GetName()}".')
-    if vSelectionMode is True:
-        vSurfaceIndices = vSurfaces.GetSelectedIndices()
-        vSurfaceIds = vSurfaces.GetSelectedIds()
-        logging.info('Exporting only %d selected surfaces.', vNumSelected)
-    elif vSelectionMode is False:
-        vSurfaceIndices = range(vSurfaces.GetNumberOfSurfaces())
-        vSurfaceIds = vSurfaces.GetIds()
-        logging.info('Exporting all surfaces in selected set.')
-    else:
-        logging.info('User canceled when asked whether to export only selected surfaces.')
-        return
+        # Get the image and channels
+        vNumberOfImages = vImarisApplication.GetNumberOfImages()
+        if vNumberOfImages != 1:
+            messagebox.showwarning('Only 1 image may be open at a time for this XTension')
+            return
 
-    print(f'Exporting {len(vSurfaceIndices)} surfaces in "{vSurfaces.GetName()}".')
-
-    vSurfaceJson = []
-    for vSurfaceIndex, vSurfaceId in zip(tqdm(vSurfaceIndices), vSurfaceIds):
-        vSurfaceData = vSurfaces.GetSurfaceData(vSurfaceIndex)
-        assert str(vSurfaceData.GetType()) == 'eTypeUInt16'
-        vSurfaceDataArray = np.array(vSurfaceData.GetDataFloats(), dtype='int16')
-        # The data array is a 5-dimensional array. The first two dimensions
-        # appear to be meaningless and have size 1. The last 3 dimensions are
-        # x, y, and z.
-        assert vSurfaceDataArray.shape[0] == 1
-        assert vSurfaceDataArray.shape[1] == 1
-        # Re-shape the data array to have axes (z, y, x).
-        vSurfaceDataArray = vSurfaceDataArray[0, 0, :, :, :].transpose([2, 1, 0])
-
-        vSurfaceJson.append({
-            'id': vSurfaceId,
-            # xRange, yRange, and zRange define the ranges of x, y, and z
-            # coordinates spanned by the bounding box filled by the mask.
-            'xRange': [vSurfaceData.GetExtendMinX(), vSurfaceData.GetExtendMaxX()],
-            'yRange': [vSurfaceData.GetExtendMinY(), vSurfaceData.GetExtendMaxY()],
-            'zRange': [vSurfaceData.GetExtendMinZ(), vSurfaceData.GetExtendMaxZ()],
-            # The mask contains positive values inside the surface and negative
-            # values outside the surface. To identify the precise boundary of
-            # the surface, interpolate between the positive and negative values
-            # to find the zero point. Alternatively, for an approximate mask,
-            # binarize on the sign of each voxel. Mask dimensions are (z, y, x).
-            'mask': vSurfaceDataArray.tolist(),
-        })
-    vSafeSurfaceName = vSurfaces.GetName().replace(' ', '_')
-    vExportPath = f'{os.path.splitext(image_path)[0]}-{vSafeSurfaceName}.json'
-    if os.path.exists(vExportPath):
-        logging.info(f'Existing file detected at {vExportPath}. Asking user for confirmation.')
-        if messagebox.askyesno(
-            'Overwrite warning',
-            f'Export destination "{vExportPath}" already exists. Overwrite?'
-        ):
-            logging.info('User chose to overwrite. Exporting.')
+        vSurfaces = vImarisApplication.GetFactory().ToSurfaces(vImarisApplication.GetSurpassSelection())
+        logging.info('Selected set of surfaces: %s', vSurfaces.GetName())
+        vNumSelected = len(vSurfaces.GetSelectedIndices())
+        vSelectionMode = messagebox.askyesnocancel(
+            'Surfaces Selection', 
+            f'Export only the {vNumSelected} selected surfaces? Choose "No" to export all surfaces in "{vSurfaces.GetName()}".')
+        if vSelectionMode is True:
+            vSurfaceIndices = vSurfaces.GetSelectedIndices()
+            vSurfaceIds = vSurfaces.GetSelectedIds()
+            logging.info('Exporting only %d selected surfaces.', vNumSelected)
+        elif vSelectionMode is False:
+            vSurfaceIndices = range(vSurfaces.GetNumberOfSurfaces())
+            vSurfaceIds = vSurfaces.GetIds()
+            logging.info('Exporting all surfaces in selected set.')
         else:
-            logging.info('User declined to overwrite. Aborting.')
+            logging.info('User canceled when asked whether to export only selected surfaces.')
             return
-    vExportData = {
-        'version': SURFACE_SERIALIZATION_SPEC_VERSION,
-        'metadata': {
-            'sourceImage': image_path,
-            'sourceSurface': vSurfaces.GetName(),
-            'sourceSoftware': vImarisApplication.GetVersion(),
-            'exportDateTime': datetime.datetime.now(
-                datetime.timezone.utc).isoformat()
-        },
-        'surfaces': vSurfaceJson,
-    }
-    print(f'Writing export to {vExportPath}')
-    with open(vExportPath, 'wb') as f:
-        f.write(orjson.dumps(vExportData, option=orjson.OPT_SERIALIZE_NUMPY))
 
-    logging.info(
-        f'Exported %d surfaces from set "%s" to "%s"',
-        len(vSurfaceJson), vSurfaces.GetName(), vExportPath,
-    )
-    logging.info('----- Done exporting surfaces from %s -----', image_path)
+        vFullPrecision = messagebox.askyesnocancel(
+            'Mask Precision',
+            'Export masks at full precision? Choose "No" to export binary masks '
+            '(inside or outside the surface only), which are about 16 times smaller.')
+        if vFullPrecision is None:
+            logging.info('User canceled when asked for the mask precision.')
+            return
+        vBinaryMask = not vFullPrecision
+        logging.info('Exporting %s masks.', 'binary' if vBinaryMask else 'full-precision')
+
+        print(f'Exporting {len(vSurfaceIndices)} surfaces in "{vSurfaces.GetName()}".')
+
+        vSafeSurfaceName = vSurfaces.GetName().replace(' ', '_')
+        vExportPath = f'{os.path.splitext(image_path)[0]}-{vSafeSurfaceName}.json'
+        if os.path.exists(vExportPath):
+            logging.info(f'Existing file detected at {vExportPath}. Asking user for confirmation.')
+            if messagebox.askyesno(
+                'Overwrite warning',
+                f'Export destination "{vExportPath}" already exists. Overwrite?'
+            ):
+                logging.info('User chose to overwrite. Exporting.')
+            else:
+                logging.info('User declined to overwrite. Aborting.')
+                return
+        vExportHeader = {
+            'version': (BINARY_MASK_SERIALIZATION_SPEC_VERSION if vBinaryMask
+                        else SURFACE_SERIALIZATION_SPEC_VERSION),
+            'metadata': {
+                'sourceImage': image_path,
+                'sourceSurface': vSurfaces.GetName(),
+                'sourceSoftware': vImarisApplication.GetVersion(),
+                'exportDateTime': datetime.datetime.now(
+                    datetime.timezone.utc).isoformat()
+            },
+        }
+        print(f'Writing export to {vExportPath}')
+        vSurfaceKeys = list(zip(vSurfaceIndices, vSurfaceIds))
+        # Surfaces are fetched from Imaris on a background thread, so the next
+        # one is retrieved while the current one is encoded and written.
+        with open(vExportPath, 'wb') as f, ThreadPoolExecutor(max_workers=1) as reader:
+            # Write the surfaces into the export's "surfaces" list one at a time,
+            # so that only one mask is held in memory instead of all of them.
+            f.write(orjson.dumps(vExportHeader)[:-1] + b',"surfaces":[')
+            if vSurfaceKeys:
+                next_surface = reader.submit(GetSurfaceJson, vSurfaces, *vSurfaceKeys[0], vBinaryMask)
+            for i in trange(len(vSurfaceKeys), mininterval=0.5):
+                aSurfaceJson = next_surface.result()
+                if i + 1 < len(vSurfaceKeys):
+                    next_surface = reader.submit(GetSurfaceJson, vSurfaces, *vSurfaceKeys[i + 1], vBinaryMask)
+                if i > 0:
+                    f.write(b',')
+                f.write(orjson.dumps(aSurfaceJson, option=orjson.OPT_SERIALIZE_NUMPY))
+            f.write(b']}')
+
+        logging.info(
+            f'Exported %d surfaces from set "%s" to "%s"',
+            len(vSurfaceIndices), vSurfaces.GetName(), vExportPath,
+        )
+        logging.info('----- Done exporting surfaces from %s -----', image_path)
 
 def ExportSurfaces(aImarisId):
     # Create an ImarisLib object
@@ -160,6 +209,6 @@ def ExportSurfaces(aImarisId):
         # accurate profile.
         #cProfile.runctx('Main(vImarisApplication)', globals=globals(), locals=locals(), filename='stats')
         Main(vImarisApplication)
-    except Exception as exception:
-        print(traceback.print_exception(type(exception), exception, exception.__traceback__))
+    except Exception:
+        traceback.print_exc()
     messagebox.showinfo('Complete', 'The XTension has terminated.')
@@ -16,14 +16,18 @@
 '''ExportSurfacesBinary exports the surfaces in an Imaris file for use outside Imaris.
 
 Unlike ExportSurfaces, ExportSurfacesBinary exports to the binary JSON-like
-messagepack format for a more compressed representation of surfaces. It is also
+messagepack format for a more compressed representation of surfaces. If the
+zstandard package is installed, the export is further compressed with zstd and
+written with a .mpk.zst extension instead of .mpk. It is also
 capable of exporting large surfaces that exceed the maximum contiguous memory
 allocation Imaris can support. However, such exports can be slow. For example,
 exporting the tissue volume surfaces from a full lung section took around 3
 hours.
 '''
 
+from contextlib import nullcontext
 import datetime
+import heapq
 import logging
 from multiprocessing import get_context
 import os
@@ -34,11 +38,25 @@ import traceback
 import ImarisLib
 
 import msgpack
+# msgspec encodes surfaces several times faster than msgpack, to the same
+# bytes, but is optional.
+try:
+    import msgspec
+    msgspec_enabled = True
+except ImportError:
+    msgspec_enabled = False
+# With zstandard, the export is compressed as it is written, which shrinks the
+# mostly empty binary masks several times over.
+try:
+    import zstandard
+    zstd_enabled = True
+except ImportError:
+    zstd_enabled = False
 from tkinter import Tk
 from tkinter import messagebox
 from tkinter import filedialog
 from tkinter import simpledialog
-from tqdm import tqdm, trange
+from tqdm import tqdm
 
 # Some DLLs that numpy needs are stored at this path, but it isn't correctly
 # set by default. We can't just set the system environment variable because
@@ -50,8 +68,20 @@ os.environ['PATH'] += f';{DLL_PATH}'
 
 import numpy as np
 
+# With Numba, surface masks are binarized and bit-packed in one fused pass.
+try:
+    from numba import njit
+    numba_enabled = True
+except ImportError:
+    numba_enabled = False
+
 LOG_FORMAT = '%(asctime)s %(levelname)s [%(pathname)s:%(lineno)d %(name)s] %(message)s'
 SURFACE_SERIALIZATION_SPEC_VERSION = "0.1.0"
+ZSTD_LEVEL = 3
+# Surfaces are split into this many tasks per worker: enough that a worker that
+# finishes early can pick up more, but few enough that balancing by voxel count
+# still groups small surfaces together.
+TASKS_PER_WORKER = 4
 
 
 imaris_handling_context = get_context()
@@ -94,6 +124,80 @@ def GetSurfacesJson(indices, ids):
     return surfaces_json
 
 
+def GetSurfacesJsonTask(task):
+    '''Call GetSurfacesJson on a (positions, indices, ids) task, for use with Pool.imap.
+
+    The positions of the surfaces in the export are returned with their JSON
+    data, so that tasks can finish in any order.'''
+    positions, indices, ids = task
+    return positions, GetSurfacesJson(indices, ids)
+
+
+def ScheduleSurfaces(vSurfaceVoxels, num_tasks):
+    '''Split surfaces into num_tasks tasks of similar total voxel counts.
+
+    Uses longest-processing-time-first scheduling: surfaces are taken from
+    largest to smallest and each goes to the task with the fewest voxels so far.
+    Returns lists of surface positions, with the heaviest task first so that
+    it is not left running after all the others have finished.'''
+    tasks = [[] for _ in range(num_tasks)]
+    loads = [(0, i) for i in range(num_tasks)]
+    for position in sorted(range(len(vSurfaceVoxels)), key=vSurfaceVoxels.__getitem__, reverse=True):
+        load, i = heapq.heappop(loads)
+        tasks[i].append(position)
+        heapq.heappush(loads, (load + vSurfaceVoxels[position], i))
+    task_loads = dict((i, load) for load, i in loads)
+    return [tasks[i] for i in sorted(task_loads, key=task_loads.__getitem__, reverse=True)]
+
+
+def BinarizeSurfaceData(values):
+    '''Return where surface data values are positive, i.e. inside the surface.
+
+    Imaris stores surface data as signed 16-bit values, which may be returned to
+    us as unsigned 16-bit integers. For example, many voxels have the value 32768
+    (2**16 / 2), which represents -32768 (the most negative int16 value). Either
+    way, a value is positive exactly when it lies in [1, 32767], which can be
+    tested on the values as returned, without first converting them to int16.'''
+    return (values > 0) & (values < 2**15)
+
+
+if numba_enabled:
+    @njit(cache=True)
+    def PackSurfaceSigns(values):
+        '''Fused BinarizeSurfaceData and np.packbits(..., bitorder='big').
+
+        Each output byte is built from 8 voxels in a register without branches
+        and stored once, which lets LLVM vectorize the inner loop.'''
+        size = values.size
+        packed = np.empty((size + 7) // 8, dtype=np.uint8)
+        full_bytes = size >> 3
+        for j in range(full_bytes):
+            byte = 0
+            for k in range(8):
+                value = values[(j << 3) + k]
+                byte = (byte << 1) | ((value > 0) & (value < 2**15))
+            packed[j] = byte
+        if size & 7:
+            # Pad the last byte with zeros, as np.packbits does.
+            byte = 0
+            for i in range((full_bytes << 3), (full_bytes << 3) + 8):
+                bit = False
+                if i < size:
+                    bit = (values[i] > 0) & (values[i] < 2**15)
+                byte = (byte << 1) | bit
+            packed[full_bytes] = byte
+        return packed
+
+
+def PackSurfaceData(values):
+    '''Binarize flat surface data on sign and pack it 8 voxels per byte.'''
+    if numba_enabled:
+        # One pass over the data, with no boolean intermediate. Each worker
+        # process packs its own surfaces, so the kernel itself is serial.
+        return PackSurfaceSigns(values).tobytes()
+    return np.packbits(BinarizeSurfaceData(values), bitorder='big').tobytes()
+
+
 def GetSurfaceJson(vSurfaceIndex, vSurfaceId):
     '''Retrieve a Surface's JSON data.
 
@@ -101,50 +205,34 @@ def GetSurfaceJson(vSurfaceIndex, vSurfaceId):
     vSurfaceData = vSurfaces.GetSurfaceData(vSurfaceIndex)
     surface_layout = vSurfaces.GetSurfaceDataLayout(vSurfaceIndex)
     assert str(vSurfaceData.GetType()) == 'eTypeUInt16'
+    vSizeZ = surface_layout.mSizeZ
+    vSizeY = surface_layout.mSizeY
+    vSizeX = surface_layout.mSizeX
     try:
-        vSurfaceDataArray = np.array(vSurfaceData.GetDataFloats(), dtype='int16')
-        # The data array is a 5-dimensional array. The first two dimensions
-        # store channel and time, and they both have size 1 since surfaces
-        # don't have multiple channels and we don't image over time. The last 3
-        # dimensions are x, y, and z.
-        assert vSurfaceDataArray.shape[0] == 1
-        assert vSurfaceDataArray.shape[1] == 1
-        # Re-shape the data array to have axes (z, y, x).
-        vSurfaceDataArray = vSurfaceDataArray[0, 0, :, :, :].transpose([2, 1, 0])
+        # Fetch the data as a flat array of shorts, its native width, rather
+        # than a nested 5D list of floats. The surface has a single channel and
+        # time point, and x varies fastest, so the flat array is already in
+        # (z, y, x) order. int32 holds the values whether they come back
+        # signed or unsigned.
+        vBinarySurfaceData = PackSurfaceData(np.array(
+            vSurfaceData.GetDataVolumeAs1DArrayShorts(0, 0), dtype=np.int32))
     except Exception as e:
         print(
             f'Error retrieving surface {vSurfaceId} at index {vSurfaceIndex}: ',
             e
         )
-        print('Retrieving surface one row along the x axis at a time')
+        print('Retrieving surface one z-slice at a time')
         # Data array has shape (z, y, x)
-        vSurfaceDataArray = np.array(
-            # Grab the surface data one z-slice at a time (fixing channel and time
-            # to index 0) so that we don't exceed the 512 MB limit for retrieving
-            # data from Imaris.
-            [
-                [
-                    np.array(
-                        vSurfaceData.GetDataSubSliceFloats(
-                            0, y, z, 0, 0, surface_layout.mSizeX, 1),
-                        # Imaris stores surface data as signed 16-bit values,
-                        # which are returned to us as unsigned 16-bit integers.
-                        # For example, many voxels have the value 32768 (2**16
-                        # / 2), which represents -32768 (the most negative
-                        # int16 value). Numpy handles converting this data to a
-                        # signed representation.
-                        dtype='int16',
-                    # Binarize array as quickly as possible to reduce memory
-                    # footprint.
-                    ) > 0
-                    for y in range(surface_layout.mSizeY)
-                ]
-                for z in range(surface_layout.mSizeZ)
-            ]
-        )
-
-    vFlatSurfaceData = vSurfaceDataArray.flatten() > 0
-    vBinarySurfaceData = np.packbits(vFlatSurfaceData, bitorder='big').tobytes()
+        vSurfaceDataArray = np.empty((vSizeZ, vSizeY, vSizeX), dtype=bool)
+        # Grab the surface data one z-slice at a time (fixing channel and time
+        # to index 0) so that we don't exceed the 512 MB limit for retrieving
+        # data from Imaris.
+        for z in range(vSizeZ):
+            vSurfaceDataArray[z] = BinarizeSurfaceData(np.array(
+                vSurfaceData.GetDataSubVolumeAs1DArrayShorts(0, 0, z, 0, 0, vSizeX, vSizeY, 1),
+                dtype=np.int32,
+            )).reshape(vSizeY, vSizeX)
+        vBinarySurfaceData = np.packbits(vSurfaceDataArray.ravel(), bitorder='big').tobytes()
 
     aSurfaceJson = {
         'id': vSurfaceId,
@@ -153,7 +241,7 @@ def GetSurfaceJson(vSurfaceIndex, vSurfaceId):
         'xRange': [vSurfaceData.GetExtendMinX(), vSurfaceData.GetExtendMaxX()],
         'yRange': [vSurfaceData.GetExtendMinY(), vSurfaceData.GetExtendMaxY()],
         'zRange': [vSurfaceData.GetExtendMinZ(), vSurfaceData.GetExtendMaxZ()],
-        'maskShape': list(vSurfaceDataArray.shape),
+        'maskShape': [vSizeZ, vSizeY, vSizeX],
         # The mask contains positive values inside the surface and negative
         # values outside the surface. To identify the precise boundary of
         # the surface, interpolate between the positive and negative values
@@ -179,60 +267,68 @@ def Main(vImarisApplication, aImarisId):
     vSurfaces = vImarisApplication.GetFactory().ToSurfaces(vImarisApplication.GetSurpassSelection())
     logging.info('Selected set of surfaces: %s', vSurfaces.GetName())
     vNumSelected = len(vSurfaces.GetSelectedIndices())
-    vSelectionMode = messagebox.askyesnocancel(
-        'Surfaces Selection', 
-        f'Export only the {vNumSelected} selected surfaces? Choose "No" to export all surfaces in "{vSurfaces.GetName()}".')
-    if vSelectionMode is True:
-        vSurfaceIndices = vSurfaces.GetSelectedIndices()
-        vSurfaceIds = vSurfaces.GetSelectedIds()
-        logging.info('Exporting only %d selected surfaces.', vNumSelected)
-    elif vSelectionMode is False:
-        vSurfaceIndices = range(vSurfaces.GetNumberOfSurfaces())
-        vSurfaceIds = vSurfaces.GetIds()
-        logging.info('Exporting all surfaces in selected set.')
-    else:
-        logging.info('User canceled when asked whether to export only selected surfaces.')
-        return
-
-    print(f'Exporting {len(vSurfaceIndices)} surfaces in "{vSurfaces.GetName()}".')
-    start = time.time()
-    print('Retrieving surface data')
-    workers = min(os.cpu_count(), len(vSurfaceIds))
-    # If num_tasks is the number of surfaces, then we operate like a typical
-    # pool of workers where each task is to retrieve one surface. If num_tasks
-    # is the number of workers, then each worker will only get one task, and we
-    # operate as if instead of using a pool we pre-partitioned the tasks among
-    # the workers.
-    num_tasks = len(vSurfaceIds)
-    tasks = [([], []) for _ in range(num_tasks)]
-    progressbar = tqdm(total=len(tasks))
+    # Start the workers before asking the user anything, so that their
+    # connections to Imaris are made while the dialog is open. At most every
+    # surface is exported, which bounds the useful number of workers.
+    workers = max(1, min(os.cpu_count(), vSurfaces.GetNumberOfSurfaces()))
     with imaris_handling_context.Pool(
         processes=workers,
         initializer=InitializeWorker,
         initargs=(aImarisId,),
     ) as pool:
-        for i, (vSurfaceIndex, vSurfaceId) in enumerate(zip(vSurfaceIndices, vSurfaceIds)):
-            tasks[i % num_tasks][0].append(vSurfaceIndex)
-            tasks[i % num_tasks][1].append(vSurfaceId)
-        results = [
-            pool.apply_async(GetSurfacesJson, (task_indices, task_ids))
-            for task_indices, task_ids in tasks
+        vSelectionMode = messagebox.askyesnocancel(
+            'Surfaces Selection', 
+            f'Export only the {vNumSelected} selected surfaces? Choose "No" to export all surfaces in "{vSurfaces.GetName()}".')
+        if vSelectionMode is True:
+            vSurfaceIndices = vSurfaces.GetSelectedIndices()
+            vSurfaceIds = vSurfaces.GetSelectedIds()
+            logging.info('Exporting only %d selected surfaces.', vNumSelected)
+        elif vSelectionMode is False:
+            vSurfaceIndices = range(vSurfaces.GetNumberOfSurfaces())
+            vSurfaceIds = vSurfaces.GetIds()
+            logging.info('Exporting all surfaces in selected set.')
+        else:
+            logging.info('User canceled when asked whether to export only selected surfaces.')
+            return
+
+        print(f'Exporting {len(vSurfaceIndices)} surfaces in "{vSurfaces.GetName()}".')
+        start = time.time()
+        print('Retrieving surface data')
+        # If num_tasks is the number of surfaces, then we operate like a typical
+        # pool of workers where each task is to retrieve one surface. If num_tasks
+        # is the number of workers, then each worker will only get one task, and we
+        # operate as if instead of using a pool we pre-partitioned the tasks among
+        # the workers. A few tasks per worker sits in between.
+        num_tasks = min(len(vSurfaceIds), TASKS_PER_WORKER * workers)
+        # Surfaces vary enormously in size, so balance the tasks by mask voxel
+        # count and start the heaviest first, rather than dealing surfaces out
+        # round-robin and waiting on whichever worker drew the big ones. The
+        # layouts are cheap to fetch compared to the masks themselves.
+        vSurfaceVoxels = []
+        for vSurfaceIndex in tqdm(vSurfaceIndices, desc='Measuring'):
+            surface_layout = vSurfaces.GetSurfaceDataLayout(vSurfaceIndex)
+            vSurfaceVoxels.append(surface_layout.mSizeX * surface_layout.mSizeY * surface_layout.mSizeZ)
+        tasks = [
+            (
+                positions,
+                [vSurfaceIndices[position] for position in positions],
+                [vSurfaceIds[position] for position in positions],
+            )
+            for positions in ScheduleSurfaces(vSurfaceVoxels, num_tasks)
         ]
-        done = 0
-        while done < len(tasks):
-            now_done = sum([res.ready() for res in results])
-            progressbar.update(now_done - done)
-            done = now_done
-            time.sleep(1)
-        vSurfaceJson = []
-        for res in results:
-            vSurfaceJson.extend(res.get(timeout=1))
+        # Tasks finish out of order, so put each surface back in its position.
+        vSurfaceJson = [None] * len(vSurfaceIds)
+        for positions, surfaces_json in tqdm(
+                pool.imap_unordered(GetSurfacesJsonTask, tasks), total=len(tasks)):
+            for position, aSurfaceJson in zip(positions, surfaces_json):
+                vSurfaceJson[position] = aSurfaceJson
     end = time.time()
-    progressbar.close()
     print(f'Surfaces retrieved in {(end - start) / 60} min')
 
     vSafeSurfaceName = vSurfaces.GetName().replace(' ', '_')
     vExportPath = f'{os.path.splitext(image_path)[0]}-{vSafeSurfaceName}.mpk'
+    if zstd_enabled:
+        vExportPath += '.zst'
     if os.path.exists(vExportPath):
         logging.info(f'Existing file detected at {vExportPath}. Asking user for confirmation.')
         if messagebox.askyesno(
@@ -243,7 +339,7 @@ def Main(vImarisApplication, aImarisId):
         else:
             logging.info('User declined to overwrite. Aborting.')
             return
-    vExportData = {
+    vExportHeader = {
         'version': SURFACE_SERIALIZATION_SPEC_VERSION,
         'metadata': {
             'sourceImage': image_path,
@@ -252,15 +348,33 @@ def Main(vImarisApplication, aImarisId):
             'exportDateTime': datetime.datetime.now(
                 datetime.timezone.utc).isoformat()
         },
-        'surfaces': vSurfaceJson,
     }
     print(f'Writing export to {vExportPath}')
     start = time.time()
-    packed_data = msgpack.packb(vExportData, strict_types=True)
-    blocksize = 1024 * 1024  # Write in 1 MiB chunks for progress bar.
-    with open(vExportPath, 'wb') as f:
-        for i in trange(0, len(packed_data), blocksize):
-            f.write(packed_data[i:i + blocksize])
+    # Pack the export map piece by piece straight into the file, one surface
+    # at a time, rather than packing it into one large bytes object first.
+    # The output is identical to packing the whole map at once.
+    # strict_types is not needed: the mask is already bytes, and msgpack keeps
+    # bytes and str apart on its own (bin vs str), so leave its fast paths on.
+    packer = msgpack.Packer()
+    if msgspec_enabled:
+        pack_surface = msgspec.msgpack.Encoder().encode
+    else:
+        pack_surface = packer.pack
+    if zstd_enabled:
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
+    with open(vExportPath, 'wb') as vExportFile, (
+        compressor.stream_writer(vExportFile) if zstd_enabled
+        else nullcontext(vExportFile)
+    ) as f:
+        f.write(packer.pack_map_header(len(vExportHeader) + 1))
+        for key, value in vExportHeader.items():
+            f.write(packer.pack(key))
+            f.write(packer.pack(value))
+        f.write(packer.pack('surfaces'))
+        f.write(packer.pack_array_header(len(vSurfaceJson)))
+        for aSurfaceJson in tqdm(vSurfaceJson):
+            f.write(pack_surface(aSurfaceJson))
     end = time.time()
     print(f'Wrote surfaces in {(end - start) / 60} min')
 
@@ -294,6 +408,6 @@ def ExportSurfacesBinary(aImarisId):
         # accurate profile.
         #cProfile.runctx('Main(vImarisApplication)', globals=globals(), locals=locals(), filename='stats')
         Main(vImarisApplication, aImarisId)
-    except Exception as exception:
-        print(traceback.print_exception(type(exception), exception, exception.__traceback__))
+    except Exception:
+        traceback.print_exc()
     messagebox.showinfo('Complete', 'The XTension has terminated.')
@@ -36,32 +36,45 @@ except Exception as e:
 try:
     from XTBatch import XTBatch
     batch_enabled = True
-except Exception as exception:
+except Exception:
     print('Importing XTBatch failed. Batching will be unavailable.')
-    print(traceback.print_exception(type(exception), exception, exception.__traceback__))
+    traceback.print_exc()
     batch_enabled = False
 
 
-def Main(vImarisApplication):
-    image_path = vImarisApplication.GetCurrentFileName()
-    image_filename = os.path.basename(image_path)
-    image_dir = os.path.dirname(image_path)
-    out_path = os.path.join(image_dir, 'dimensions.csv')
+OUT_BUFFER_BYTES = 1024 * 1024
+
+
+def GetDimensionsPath(vImarisApplication):
+    '''Return the path of the dimensions.csv next to the open image.'''
+    image_dir = os.path.dirname(vImarisApplication.GetCurrentFileName())
+    return os.path.join(image_dir, 'dimensions.csv')
+
+
+def Main(vImarisApplication, writer=None):
+    '''Append the open image's extents to dimensions.csv.
+
+    When batching, pass a csv writer for the already open output file, so that
+    it is opened once for the whole batch rather than once per image.'''
+    if writer is None:
+        with open(GetDimensionsPath(vImarisApplication), 'a', newline='') as f:
+            Main(vImarisApplication, csv.writer(f))
+        return
+
+    image_filename = os.path.basename(vImarisApplication.GetCurrentFileName())
 
     # Get the image
     assert vImarisApplication.GetNumberOfImages() == 1
     vImage = vImarisApplication.GetImage(0)
-    with open(out_path, 'a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow([
-            image_filename,
-            vImage.GetExtendMinX(),
-            vImage.GetExtendMaxX(),
-            vImage.GetExtendMinY(),
-            vImage.GetExtendMaxY(),
-            vImage.GetExtendMinZ(),
-            vImage.GetExtendMaxZ(),
-        ])
+    writer.writerow([
+        image_filename,
+        vImage.GetExtendMinX(),
+        vImage.GetExtendMaxX(),
+        vImage.GetExtendMinY(),
+        vImage.GetExtendMaxY(),
+        vImage.GetExtendMinZ(),
+        vImage.GetExtendMaxZ(),
+    ])
 
 
 def GetDimensions(aImarisId):
@@ -91,11 +104,14 @@ def GetDimensions(aImarisId):
             ['All', 'Some', 'Only the open file']
         )
 
+    # Every image in a batch is in the same folder, so they all append to the
+    # same dimensions.csv. Open it once and buffer the rows.
     if batching == 'All':
         try:
-            XTBatch(vImarisApplication, Main, operate_on_image=False, save=False)
-        except Exception as exception:
-            print(traceback.print_exception(type(exception), exception, exception.__traceback__))
+            with open(GetDimensionsPath(vImarisApplication), 'a', newline='', buffering=OUT_BUFFER_BYTES) as f:
+                XTBatch(vImarisApplication, Main, args=(csv.writer(f),), operate_on_image=False, save=False)
+        except Exception:
+            traceback.print_exc()
             messagebox.showerror('Error', 'Failure while running batch.')
             return
     elif batching == 'Some':
@@ -109,9 +125,10 @@ def GetDimensions(aImarisId):
             if not path.endswith('.ims'):
                 raise RuntimeError(f'Selected file not an .ims file: {path}')
         try:
-            XTBatch(vImarisApplication, Main, operate_on_image=False, save=False, filenames=filenames)
-        except Exception as exception:
-            print(traceback.print_exception(type(exception), exception, exception.__traceback__))
+            with open(GetDimensionsPath(vImarisApplication), 'a', newline='', buffering=OUT_BUFFER_BYTES) as f:
+                XTBatch(vImarisApplication, Main, args=(csv.writer(f),), operate_on_image=False, save=False, filenames=filenames)
+        except Exception:
+            traceback.print_exc()
             messagebox.showerror('Error', 'Failure while running batch.')
             return
     else:
@@ -121,8 +138,8 @@ def GetDimensions(aImarisId):
             return
         try:
             Main(vImarisApplication)
-        except Exception as exception:
-            print(traceback.print_exception(type(exception), exception, exception.__traceback__))
+        except Exception:
+            traceback.print_exc()
             messagebox.showerror('Error', 'Failure while running un-batched.')
             return
 
@@ -40,6 +40,7 @@ logged changes may not actually be saved if the user chooses not to.
 # essential dependencies
 try:
     import csv
+    import importlib.util
     import logging
     import traceback
     import ImarisLib
@@ -54,6 +55,14 @@ except Exception as e:
     input("Press enter to exit;")
     raise
 
+# pyarrow's CSV reader is multithreaded and much faster on wide tables, but
+# optional. pandas only accepts it as a read_csv engine from version 1.4 on.
+# Only probe for it, since importing all of pyarrow just to pick an engine is slow.
+pyarrow_enabled = (
+    importlib.util.find_spec('pyarrow') is not None
+    and tuple(int(part) for part in pd.__version__.split('.')[:2]) >= (1, 4)
+)
+
 LOG_FORMAT = '%(asctime)s %(levelname)s [%(pathname)s:%(lineno)d %(name)s] %(message)s'
 
 def Main(aImarisId):
@@ -132,9 +141,13 @@ def Main(aImarisId):
         'Would you like to apply changes to all .ims files in this folder?'
     )    
 
-    with tk.filedialog.askopenfile(mode='r', title='Select statistic CSV file to be imported') as f:
-        logging.info(f'Reading statistics from {f.name}')
-        new_stats_df=pd.read_csv(f)
+    vStatsPath=tk.filedialog.askopenfilename(title='Select statistic CSV file to be imported')
+    if not vStatsPath:
+        logging.info('User canceled statistics selection.')
+        return
+    logging.info(f'Reading statistics from {vStatsPath}')
+    # The pyarrow engine opens the file itself, so pass it the path.
+    new_stats_df=pd.read_csv(vStatsPath, engine='pyarrow' if pyarrow_enabled else 'c')
 
 
     # check formatting of statistics dataframe
@@ -190,40 +203,25 @@ def ImageImportStatistics(vImarisApplication,vObjectName,id,new_stats_df):
     vObjects=vScene.GetChild(vObjectIndex)
     vSurfaces=vFactory.ToSurfaces(vObjects)
 
-    # set up arguments for adding statistics
-    vIndividualSurfaceIDs=new_stats_df[id]
-    vIndividualStatUnits=[None]*len(vIndividualSurfaceIDs)
+    # Every column after the ID column is a statistic. Imaris accepts several
+    # statistics in one AddStatistics call, so concatenate them column by
+    # column and add them all in a single round trip.
+    vNewStatNames=list(new_stats_df.columns[1:])
+    vIndividualSurfaceIDs=new_stats_df[id].to_numpy().tolist()
+    vNumberOfValues=len(vIndividualSurfaceIDs)*len(vNewStatNames)
+    vSurfaceStatNames=[new_stat_name for new_stat_name in vNewStatNames
+                       for _ in vIndividualSurfaceIDs]
+    vSurfaceStatValues=new_stats_df[vNewStatNames].to_numpy(dtype=np.float64).ravel(order='F').tolist()
+    vSurfaceIDs=vIndividualSurfaceIDs*len(vNewStatNames)
+    vIndividualStatUnits=[None]*vNumberOfValues
     #Create Tuple list for each surface in time
-    vSurfaceStatFactors=(['Surface']*len(vIndividualSurfaceIDs),
-                [str(1)]*len(vIndividualSurfaceIDs))
+    vSurfaceStatFactors=(['Surface']*vNumberOfValues,
+                [str(1)]*vNumberOfValues)
     vSurfaceStatFactorName=['Category','Time']
-        # stat_name_list=vSurfaces.GetStatisticsNames()
-
-        # vAllTimeIndices = []
-        # for vNextSurface in range (vNumberOfSurfaces):
-        #     vAllTimeIndices.append(vSurfaces.GetTimeIndex(vNextSurface))
-        # print(vAllTimeIndices,len(vAllTimeIndices))
-        ##############################################################################
-    for i in range(1,len(new_stats_df.columns)):
-        # get name of statistic
-        new_stat_name=new_stats_df.iloc[:,i].name
-        # if new_stat_name in stat_name_list:
-        #     proceed = tk.messagebox.askyesno(
-        #         'Save changes.',
-        #         f'{NameObjects[vObjectIndex]} already contains statistic {new_stat_name} \n Would you like to overwrite the existing values?'
-        #     )
-        #     logging.info(f'Found existing statistic {new_stat_name}. User chose to overwrite: {proceed}.')
-        # else:
-        #     proceed=True
-        # if proceed:
-        vSurfaceStatNames=[new_stat_name]*len(vIndividualSurfaceIDs)
-        # get value of statistics
-        vSurfaceStatValues=list(new_stats_df.iloc[:,i])
-        # add statistic to surface
-        vSurfaces.AddStatistics(vSurfaceStatNames, vSurfaceStatValues,
-                                vIndividualStatUnits, vSurfaceStatFactors,
-                                vSurfaceStatFactorName, vIndividualSurfaceIDs)
-        logging.info(f'Added new statistic {new_stat_name}.')
+    vSurfaces.AddStatistics(vSurfaceStatNames, vSurfaceStatValues,
+                            vIndividualStatUnits, vSurfaceStatFactors,
+                            vSurfaceStatFactorName, vSurfaceIDs)
+    logging.info(f'Added new statistics {vNewStatNames}.')
     
 
 
@@ -235,6 +233,6 @@ def ImportStatistics(aImarisId):
 
     try:
         Main(aImarisId)
-    except Exception as exception:
-        print(traceback.print_exception(type(exception), exception, exception.__traceback__))
+    except Exception:
+        traceback.print_exc()
     tk.messagebox.showinfo('Complete', 'The XTension has terminated.')
@@ -16,6 +16,7 @@
 '''ImportSurfaces exports the surfaces in an Imaris file for use outside Imaris.
 '''
 
+import base64
 import logging
 import os
 import sys
@@ -43,6 +44,7 @@ import numpy as np
 
 LOG_FORMAT = '%(asctime)s %(levelname)s [%(pathname)s:%(lineno)d %(name)s] %(message)s'
 
+
 class TqdmStreamHandler(logging.StreamHandler):
     """StreamHandler that writes through tqdm.write() to avoid breaking progress bars."""
     def emit(self, record):
@@ -53,6 +55,59 @@ class TqdmStreamHandler(logging.StreamHandler):
         except Exception:
             self.handleError(record)
 
+def IsPackedSurfaceMask(vSurfaceJsonData):
+    return vSurfaceJsonData.get('maskEncoding') == 'packbits-base64'
+
+
+def DecodeSurfaceMask(vSurfaceJsonData):
+    '''Return a surface's mask as a (z, y, x) array of signed 16-bit values.
+
+    Binary masks from ExportSurfaces are bit-packed and base64 encoded; they are
+    unpacked with NumPy and mapped to 1 inside the surface and -1 outside, which
+    keeps the sign that the full-precision mask would have had.'''
+    if IsPackedSurfaceMask(vSurfaceJsonData):
+        vShape = vSurfaceJsonData['maskShape']
+        vBits = np.unpackbits(
+            np.frombuffer(base64.b64decode(vSurfaceJsonData['mask']), dtype=np.uint8),
+            count=int(np.prod(vShape)),
+            bitorder='big',
+        )
+        return (vBits.astype(np.int16) * 2 - 1).reshape(vShape)
+    # The full-precision mask is a nested list with axes (z, y, x)
+    return np.array(vSurfaceJsonData['mask'], dtype=np.int16)
+
+
+def AddSurfaceJson(vImarisApplication, vSurfaces, vSurfaceJsonData, vData):
+    '''Add one surface, whose mask vData was decoded from its JSON data, to vSurfaces.
+
+    Returns None if the surface was added, or a message describing why it was skipped.'''
+    vSizeZ, vSizeY, vSizeX = vData.shape
+
+    # create aSurfaceData dataset
+    aSurfaceData = vImarisApplication.GetFactory().CreateDataSet()
+    aSurfaceData.Create(Imaris.tType.eTypeUInt16, vSizeX, vSizeY, vSizeZ, 1, 1)
+    # Upload the mask as one flat list of shorts. A C-order ravel of (z, y, x)
+    # has x varying fastest, as Imaris expects, so no transpose or nested
+    # list of floats is needed.
+    aSurfaceData.SetDataVolumeAs1DArrayShorts(vData.ravel().tolist(), aIndexC=0, aIndexT=0)
+
+    aSurfaceData.SetExtendMinX(vSurfaceJsonData['xRange'][0])
+    aSurfaceData.SetExtendMaxX(vSurfaceJsonData['xRange'][1])
+
+    aSurfaceData.SetExtendMinY(vSurfaceJsonData['yRange'][0])
+    aSurfaceData.SetExtendMaxY(vSurfaceJsonData['yRange'][1])
+
+    aSurfaceData.SetExtendMinZ(vSurfaceJsonData['zRange'][0])
+    aSurfaceData.SetExtendMaxZ(vSurfaceJsonData['zRange'][1])
+
+    # add aSurfaceData to Surfaces
+    try:
+        vSurfaces.AddSurface(aSurfaceData, 0) # second number is time index which is irrelevant
+    except Exception as e:
+        return f'Failed to add surface:\n{e}\nThe skipped surface:\n{vData}'
+    return None
+
+
 def Main(vImarisApplication):
     vStartTime = time.time()
     image_path = vImarisApplication.GetCurrentFileName()
@@ -86,34 +141,22 @@ def Main(vImarisApplication):
 
     with open(vFilePath, 'rb') as f:
         vSurfaceJson = orjson.loads(f.read())
+    # ExportSurfaces writes a header with the surfaces listed under 'surfaces';
+    # older exports are a bare list of surfaces.
+    if isinstance(vSurfaceJson, dict):
+        vSurfaceJson = vSurfaceJson['surfaces']
 
     n_skipped = 0
     logging.info('Importing %d surfaces', len(vSurfaceJson))
+    # Masks are decoded one at a time, just before their surface is added, so
+    # only one decoded mask is held in memory. Surfaces are added in file order,
+    # since Imaris assigns surface IDs in the order surfaces are added.
     for vSurfaceJsonData in tqdm(vSurfaceJson, desc='Importing'):
-        vData = np.array(vSurfaceJsonData['mask'], dtype=np.uint16).transpose([2, 1, 0])
+        vData = DecodeSurfaceMask(vSurfaceJsonData)
         vSurfaceJsonData['mask'] = None  # free JSON mask data
-        vSizeX, vSizeY, vSizeZ = vData.shape
-
-        # create aSurfaceData dataset
-        aSurfaceData = vImarisApplication.GetFactory().CreateDataSet()
-        aSurfaceData.Create(Imaris.tType.eTypeUInt16, vSizeX, vSizeY, vSizeZ, 1, 1)
-        aSurfaceData.SetDataVolumeFloats(vData.tolist(), aIndexC=0, aIndexT=0)
-
-        aSurfaceData.SetExtendMinX(vSurfaceJsonData['xRange'][0])
-        aSurfaceData.SetExtendMaxX(vSurfaceJsonData['xRange'][1])
-
-        aSurfaceData.SetExtendMinY(vSurfaceJsonData['yRange'][0])
-        aSurfaceData.SetExtendMaxY(vSurfaceJsonData['yRange'][1])
-
-        aSurfaceData.SetExtendMinZ(vSurfaceJsonData['zRange'][0])
-        aSurfaceData.SetExtendMaxZ(vSurfaceJsonData['zRange'][1])
-
-        # add aSurfaceData to Surfaces
-        try:
-            vSurfaces.AddSurface(aSurfaceData, 0) # second number is time index which is irrelevant
-        except Exception as e:
-            logging.warning(f'Failed to add surface:\n{e}')
-            logging.warning(f'The skipped surface:\n{vData}')
+        vSkipMessage = AddSurfaceJson(vImarisApplication, vSurfaces, vSurfaceJsonData, vData)
+        if vSkipMessage is not None:
+            logging.warning(vSkipMessage)
             n_skipped += 1
 
     vSurfaces.SetName(vSurfaceName)
@@ -158,6 +201,6 @@ def ImportSurfaces(aImarisId):
 
     try:
         Main(vImarisApplication)
-    except Exception as exception:
-        print(traceback.print_exception(type(exception), exception, exception.__traceback__))
+    except Exception:
+        traceback.print_exc()
     messagebox.showinfo('Complete', 'The XTension has terminated.')
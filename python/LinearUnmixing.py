@@ -39,24 +39,50 @@ logged changes may not actually be saved if the user chooses not to.
 '''
 
 try:
-    import csv
+    import functools
     import logging
+    import threading
     import traceback
     import ImarisLib
     from XTBatch import XTBatch
     from tkinter import *
     from tkinter import messagebox
     from tkinter import filedialog
+    import os
     import numpy as np
-    from tqdm.contrib.itertools import product
+    from concurrent.futures import ThreadPoolExecutor
+    from tqdm import tqdm
+
+    from utils import MAX_TRANSFER_BYTES, get_dtype_info
 except Exception as e:
     print(e)
     input("Press enter to exit;")
     raise
 
+# With Numba, each tile is unmixed, clipped, and converted back to the image type in one fused pass.
+try:
+    from numba import njit, prange
+    numba_enabled = True
+except ImportError:
+    numba_enabled = False
 
+# Without Numba, large tiles can instead be unmixed on a CUDA GPU with CuPy.
+try:
+    import cupy as cp
+    cupy_enabled = cp.cuda.runtime.getDeviceCount() > 0
+except Exception:
+    cupy_enabled = False
 
 
+# Without Numba, tiles are unmixed in blocks of this many pixels, so that the float32
+# intermediates stay in cache instead of spanning the whole tile.
+UNMIX_BLOCK_PIXELS = 16 * 1024
+# Memory for the tile buffers (two source tiles and two output tiles). Larger tiles mean
+# fewer Imaris calls per slice; a whole slice is one tile whenever it fits.
+TILE_BUFFER_BYTES = 1024 * 1024 * 1024
+# Tiles with fewer pixels than this stay on the CPU, where they are not worth the transfer.
+GPU_MIN_PIXELS = 1024 * 1024
+
 LOG_FORMAT = '%(asctime)s %(levelname)s [%(pathname)s:%(lineno)d %(name)s] %(message)s'
 
 def Main(aImarisId):
@@ -81,11 +107,8 @@ def Main(aImarisId):
 
     with filedialog.askopenfile(mode='r', title='Select CSV specifying compensation matrix') as f:
         logging.info('Using compensation matrix from %s', f.name)
-        reader = csv.reader(f)
-        matrix = []
-        for row in reader:
-            matrix.append(row)
-    matrix=np.array(matrix,dtype=np.float32)
+        # parse the numbers in C rather than through a list of lists of strings
+        matrix=np.loadtxt(f,delimiter=',',dtype=np.float32,ndmin=2)
     if matrix.shape[0] != matrix.shape[1]:
         raise RuntimeError(
             f'Number of rows in compensation matrix ({matrix.shape[0]}) '
@@ -93,7 +116,20 @@ def Main(aImarisId):
         )
     
     logging.info('Calculating unmixing matrix.')
-    unmixing_matrix=np.linalg.pinv(matrix)
+    logging.info('Compensation matrix condition number: %g', np.linalg.cond(matrix))
+    # The compensation matrix is expected to be square and invertible, so invert it
+    # directly; the SVD-based pseudoinverse is only needed when it is singular.
+    try:
+        unmixing_matrix=np.linalg.inv(matrix)
+    except np.linalg.LinAlgError:
+        logging.warning('Compensation matrix is singular. Using its pseudoinverse.')
+        unmixing_matrix=np.linalg.pinv(matrix)
+    # float32 so that unmixing runs as a single-precision GEMM
+    unmixing_matrix=unmixing_matrix.astype(np.float32,copy=False)
+    if numba_enabled and vImarisApplication.GetNumberOfImages()>0:
+        # Compile the kernel for the current image while the user answers the dialog below.
+        vStorageDtype=get_dtype_info(vImarisApplication.GetImage(0))[0]
+        threading.Thread(target=GetUnmixTileKernel,args=(unmixing_matrix.shape[0],vStorageDtype),daemon=True).start()
 
 
     batched=messagebox.askyesno(
@@ -122,8 +158,86 @@ def Main(aImarisId):
         logging.info('----- Done Editing %s -----', image_path)
     print('Changes complete.')
 
+def QuantizeUnmixingMatrix(unmixing_matrix):
+    '''Return (int16 matrix, fraction bits) approximating unmixing_matrix in fixed point.
+
+    The matrix is scaled by the largest power of two that keeps every entry within
+    int16, so a typical matrix with entries near 1 keeps 14 fraction bits and the
+    unmixed values are within one grey level of the floating-point result.'''
+    vMaxEntry=np.abs(unmixing_matrix).max()
+    fraction_bits=15 if vMaxEntry==0 else int(np.floor(np.log2(32767/vMaxEntry)))
+    fraction_bits=min(max(fraction_bits,0),23)
+    quantized=np.clip(np.round(unmixing_matrix*2.0**fraction_bits),-32768,32767).astype(np.int16)
+    return quantized,fraction_bits
+
+
+# Serializes kernel compilation, so that a kernel being compiled in the background is
+# waited for rather than compiled a second time.
+_kernel_lock = threading.Lock()
+
+def GetUnmixTileKernel(num_channels, storage_dtype=np.uint8):
+    '''Return UnmixTile compiled for a fixed number of channels and image type (requires Numba).
+
+    8-bit images are unmixed in fixed point; 16-bit and float images in float32.'''
+    with _kernel_lock:
+        if np.dtype(storage_dtype) == np.uint8:
+            return _CompileUnmixTileKernel(num_channels)
+        return _CompileUnmixTileKernelFloat(num_channels, np.dtype(storage_dtype).name)
+
+
+@functools.lru_cache(maxsize=None)
+def _CompileUnmixTileKernel(num_channels):
+    '''Compile UnmixTile for a fixed number of channels.
+
+    num_channels is baked into the kernel as a constant, so LLVM fully unrolls
+    the channel loops and keeps every accumulator and weight in registers. The
+    kernel is compiled eagerly for its one signature and cached on disk, so only
+    the first run with a given number of channels pays for compilation.'''
+    @njit('void(uint8[:,::1], int16[:,::1], int64, uint8[:,::1])', parallel=True, fastmath=True, cache=True)
+    def UnmixTile(source, quantized_matrix, fraction_bits, output):
+        '''Fused fixed-point matmul, clip to [0, 255], and floor to uint8 over (channels, pixels) arrays.
+
+        uint8 pixels times int16 weights accumulate exactly in int32, which LLVM
+        vectorizes to multiply-add instructions on packed integers.'''
+        num_pixels = source.shape[1]
+        for i in prange(num_pixels):
+            for j in range(num_channels):
+                acc = np.int32(0)
+                for k in range(num_channels):
+                    acc += np.int32(source[k, i]) * np.int32(quantized_matrix[k, j])
+                acc >>= fraction_bits
+                # min/max rather than branches, so that the clip and the narrowing to
+                # uint8 lower to packed min/max and saturating pack instructions
+                output[j, i] = np.uint8(min(max(acc, 0), 255))
+    return UnmixTile
+
+
+@functools.lru_cache(maxsize=None)
+def _CompileUnmixTileKernelFloat(num_channels, storage_dtype_name):
+    '''Compile UnmixTile for a fixed number of channels and a uint16 or float32 image.
+
+    As for 8-bit images, but the pixels are unmixed with float32 weights, since
+    16-bit pixels times int16 weights could overflow an int32 accumulator.'''
+    clip = storage_dtype_name == 'uint16'
+    @njit(f'void({storage_dtype_name}[:,::1], float32[:,::1], {storage_dtype_name}[:,::1])', parallel=True, fastmath=True, cache=True)
+    def UnmixTile(source, unmixing_matrix, output):
+        '''Fused matmul, clip to [0, 65535] for uint16, and floor to the image type over (channels, pixels) arrays.'''
+        num_pixels = source.shape[1]
+        for i in prange(num_pixels):
+            for j in range(num_channels):
+                acc = np.float32(0)
+                for k in range(num_channels):
+                    acc += np.float32(source[k, i]) * unmixing_matrix[k, j]
+                if clip:
+                    acc = min(max(acc, np.float32(0)), np.float32(65535))
+                output[j, i] = acc
+    return UnmixTile
+
+
 def ImageLinearUnmixing(vImage,unmixing_matrix):
 
+    storage_dtype, _, clip_min, clip_max, method_suffix = get_dtype_info(vImage)
+    vItemSize = np.dtype(storage_dtype).itemsize
     vNumChannels = vImage.GetSizeC()
     vNumSlices = vImage.GetSizeZ()
     vXSize = vImage.GetSizeX()
@@ -137,22 +251,144 @@ def ImageLinearUnmixing(vImage,unmixing_matrix):
 
 
     logging.info('Unmixing image.')
-    vImageNew = vImage.Clone()
-    #process data slice by slice in square windows of length vWindowSize pixels
-    vWindowSize = 10000 # larger windows can speed up execution but will be more memory-intensive
-    for x,y,z in product(range(0,vXSize,vWindowSize),range(0,vYSize,vWindowSize),range(vNumSlices)):
-        window_x_len=min(vWindowSize,vXSize-x)
-        window_y_len=min(vWindowSize,vYSize-y)
-        vImageArray=np.zeros((window_x_len,window_y_len,vNumChannels)) # container for subslice of image as numpy array
+    # Every voxel is overwritten, so unmix in place rather than cloning the image first.
+    # Each tile is read in full before it is written back, and tiles do not overlap.
+    #process data in bands of whole rows, each band as tall as the tile buffers allow and each
+    # channel of a band within a single Imaris transfer. When whole slices fit, a tile instead
+    # holds as many whole slices as fit, so that small images are unmixed in one or a few GEMMs.
+    vWindowXSize=vXSize
+    vRowBytes=vXSize*vItemSize
+    vWindowYSize=max(1,min(vYSize,TILE_BUFFER_BYTES//(4*vNumChannels*vRowBytes),MAX_TRANSFER_BYTES//vRowBytes))
+    vWindowZSize=1
+    if vWindowYSize==vYSize:
+        vSliceBytes=vRowBytes*vYSize
+        vWindowZSize=max(1,min(vNumSlices,TILE_BUFFER_BYTES//(4*vNumChannels*vSliceBytes),MAX_TRANSFER_BYTES//vSliceBytes))
+    # Allocate the tile buffers once, sized for a full window.
+    # They are flat so that every tile, including smaller edge tiles, is a contiguous prefix
+    # that reshapes to (channels, z, y, x) or (channels, pixels) without a copy. Keeping channels
+    # outermost makes each channel, which Imaris reads and writes separately, one contiguous
+    # block.
+    vBufferSize=vWindowXSize*vWindowYSize*vWindowZSize*vNumChannels
+    # two source buffers, so that the next tile can be read into one while the other is unmixed
+    vSourceBuffers=[np.empty(vBufferSize,dtype=storage_dtype) for _ in range(2)] # containers for subslices of image as numpy arrays
+    # and two output buffers, so that the previous tile can be written from one while the other is filled
+    vOutputBuffers=[np.empty(vBufferSize,dtype=storage_dtype) for _ in range(2)]
+    if not numba_enabled:
+        # Without Numba, blocks are spread over one thread per core; BLAS and NumPy's ufuncs
+        # release the GIL, so the threads run in parallel. Each thread gets its own float32
+        # scratch buffers (float32 holds any uint8 or uint16 value exactly).
+        vNumUnmixers=os.cpu_count() or 1
+        vScratchBuffers=[(np.empty(UNMIX_BLOCK_PIXELS*vNumChannels,dtype=np.float32),
+                          np.empty(UNMIX_BLOCK_PIXELS*vNumChannels,dtype=np.float32)) for _ in range(vNumUnmixers)]
+    unmixing_matrix=unmixing_matrix.astype(np.float32,copy=False)
+    if numba_enabled:
+        UnmixTile=GetUnmixTileKernel(vNumChannels,storage_dtype)
+        if method_suffix=='Bytes':
+            quantized_matrix,fraction_bits=QuantizeUnmixingMatrix(unmixing_matrix)
+            vKernelArgs=(quantized_matrix,fraction_bits)
+        else:
+            vKernelArgs=(np.ascontiguousarray(unmixing_matrix),)
+    elif cupy_enabled:
+        vUnmixingMatrixGpu=cp.asarray(unmixing_matrix.T)
+    tiles=[(x,y,z) for x in range(0,vXSize,vWindowXSize) for y in range(0,vYSize,vWindowYSize) for z in range(0,vNumSlices,vWindowZSize)]
+
+    get_sub_volume=getattr(vImage,f'GetDataSubVolumeAs1DArray{method_suffix}')
+    set_sub_volume=getattr(vImage,f'SetDataSubVolumeAs1DArray{method_suffix}')
+
+    def read_tile(x,y,z,vSourceBuffer):
+        window_x_len=min(vWindowXSize,vXSize-x)
+        window_y_len=min(vWindowYSize,vYSize-y)
+        window_z_len=min(vWindowZSize,vNumSlices-z)
+        vSourceArray=vSourceBuffer[:vNumChannels*window_z_len*window_y_len*window_x_len].reshape(vNumChannels,window_z_len,window_y_len,window_x_len)
         for c in range(vNumChannels): # write each channel of image to array
-            vImageArray[:,:,c]=np.array([np.frombuffer(row,dtype=np.uint8) for row in vImage.GetDataSubSliceBytes(aIndexX=x,aIndexY=y,aIndexZ=z,aIndexC=c,aIndexT=0,aSizeX=window_x_len,aSizeY=window_y_len)])
-        vImageArrayUnmixed=np.uint8(np.matmul(vImageArray,unmixing_matrix).clip(0,255)) #apply matrix unmixing, truncate values below zero or above 255, and convert to integer format
-        # np.uint8 returns an array with floor applied element-wise. rounding by np.rint does not appear to obviously affect the unmixed image and slows down the code slightly
-        #TODO: compatibility for 16bit and 32bit images
+            # Fetch the window as one flat array (x varies fastest) rather than a list of rows.
+            # Bytes are reinterpreted without copying; 16-bit data may come back as signed
+            # shorts, which the assignment casts to uint16.
+            vData=get_sub_volume(aIndexX=x,aIndexY=y,aIndexZ=z,aIndexC=c,aIndexT=0,aSizeX=window_x_len,aSizeY=window_y_len,aSizeZ=window_z_len)
+            if method_suffix=='Bytes':
+                vData=np.frombuffer(vData,dtype=np.uint8)
+            vSourceArray[c]=np.asarray(vData).astype(storage_dtype,copy=False).reshape(window_z_len,window_y_len,window_x_len)
+        return vSourceArray
+
+    def unmix_span(vSourcePixels,vUnmixedPixels,span,vScratchBuffer):
+        vImageBuffer,vUnmixedBuffer=vScratchBuffer
+        for start in range(span[0],span[1],UNMIX_BLOCK_PIXELS):
+            stop=min(start+UNMIX_BLOCK_PIXELS,span[1])
+            # as one (channels, channels) x (channels, pixels) product, which BLAS runs as a single GEMM
+            vImageArray=vImageBuffer[:vNumChannels*(stop-start)].reshape(vNumChannels,-1)
+            np.copyto(vImageArray,vSourcePixels[:,start:stop])
+            vUnmixedArray=vUnmixedBuffer[:vNumChannels*(stop-start)].reshape(vNumChannels,-1)
+            np.dot(unmixing_matrix.T,vImageArray,out=vUnmixedArray)
+            if clip_max is not None:
+                np.clip(vUnmixedArray,clip_min,clip_max,out=vUnmixedArray)
+            np.copyto(vUnmixedPixels[:,start:stop],vUnmixedArray,casting='unsafe')
+
+    def write_tile(x,y,z,vImageArrayUnmixed):
+        vTileShape=vImageArrayUnmixed.shape
         for c in range(vNumChannels): #write each channel of array to new image
-            vImageNew.SetDataSubSliceBytes(aData=[row.tobytes() for row in vImageArrayUnmixed[:,:,c]],aIndexX=x,aIndexY=y,aIndexZ=z,aIndexC=c,aIndexT=0)
+            # each channel is one contiguous block, so it goes to Imaris in a single call
+            if method_suffix=='Bytes':
+                vData=vImageArrayUnmixed[c].tobytes()
+            elif method_suffix=='Shorts':
+                # Imaris takes signed shorts, so reinterpret uint16 values above 32767
+                vData=vImageArrayUnmixed[c].view(np.int16).ravel().tolist()
+            else:
+                vData=vImageArrayUnmixed[c].ravel().tolist()
+            set_sub_volume(aData=vData,aIndexX=x,aIndexY=y,aIndexZ=z,aIndexC=c,aIndexT=0,aSizeX=vTileShape[3],aSizeY=vTileShape[2],aSizeZ=vTileShape[1])
+
+    # The image is unmixed in place, so a failure partway through leaves it partly
+    # unmixed. Warn before re-raising, so that the image is not saved.
+    try:
+        # Reads and writes each run on their own background thread, so that Imaris I/O of
+        # the next and previous tiles overlaps unmixing of the current one. Each thread
+        # makes one Imaris call at a time.
+        with ThreadPoolExecutor(max_workers=1) as reader, \
+             ThreadPoolExecutor(max_workers=1) as writer, \
+             ThreadPoolExecutor(max_workers=1 if numba_enabled else vNumUnmixers) as unmixers:
+            next_tile=reader.submit(read_tile,*tiles[0],vSourceBuffers[0])
+            previous_write=None
+            # disable=None turns the progress bar off when stderr is not a terminal
+            for k,(x,y,z) in enumerate(tqdm(tiles,mininterval=0.5,disable=None)):
+                vSourceArray=next_tile.result()
+                if k+1<len(tiles):
+                    next_tile=reader.submit(read_tile,*tiles[k+1],vSourceBuffers[(k+1)%2])
+                vTileShape=vSourceArray.shape
+                vTileSize=vSourceArray.size
+                #apply matrix unmixing, truncate values outside the range of the image type, and convert back to it
+                # the write that last used this output buffer finished before the previous write was queued
+                vImageArrayUnmixed=vOutputBuffers[k%2][:vTileSize].reshape(vTileShape)
+                if numba_enabled:
+                    UnmixTile(vSourceArray.reshape(vNumChannels,-1),*vKernelArgs,vImageArrayUnmixed.reshape(vNumChannels,-1))
+                elif cupy_enabled and vTileSize//vNumChannels>=GPU_MIN_PIXELS:
+                    # one cuBLAS GEMM on the GPU, moving only pixels of the image type across the bus
+                    vUnmixedGpu=cp.matmul(vUnmixingMatrixGpu,cp.asarray(vSourceArray.reshape(vNumChannels,-1)).astype(cp.float32))
+                    if clip_max is not None:
+                        cp.clip(vUnmixedGpu,clip_min,clip_max,out=vUnmixedGpu)
+                    vUnmixedGpu.astype(storage_dtype).get(out=vImageArrayUnmixed.reshape(vNumChannels,-1))
+                else:
+                    vSourcePixels=vSourceArray.reshape(vNumChannels,-1)
+                    vUnmixedPixels=vImageArrayUnmixed.reshape(vNumChannels,-1)
+                    # one contiguous span of whole blocks per thread
+                    vSpanPixels=-(-vSourcePixels.shape[1]//vNumUnmixers)
+                    vSpanPixels=-(-vSpanPixels//UNMIX_BLOCK_PIXELS)*UNMIX_BLOCK_PIXELS
+                    vSpans=[(start,min(start+vSpanPixels,vSourcePixels.shape[1])) for start in range(0,vSourcePixels.shape[1],vSpanPixels)]
+                    for _ in unmixers.map(unmix_span,[vSourcePixels]*len(vSpans),[vUnmixedPixels]*len(vSpans),vSpans,vScratchBuffers):
+                        pass
+                # casting to an integer type applies floor element-wise. rounding by np.rint does not appear to obviously affect the unmixed image and slows down the code slightly
+                if previous_write is not None:
+                    previous_write.result()
+                previous_write=writer.submit(write_tile,x,y,z,vImageArrayUnmixed)
+            previous_write.result()
+    except Exception:
+        logging.exception('Unmixing failed. The image may be partly unmixed.')
+        messagebox.showwarning(
+            'Unmixing failed',
+            'Unmixing failed partway through, so the image may be partly unmixed. '
+            'Discard it without saving.'
+        )
+        raise
     logging.info('Unmixing complete.')
-    return vImageNew
+    return vImage
 
 
 def LinearUnmixing(aImarisId):
@@ -162,8 +398,8 @@ def LinearUnmixing(aImarisId):
 
     try:
         Main(aImarisId)
-    except Exception as exception:
-        print(traceback.print_exception(type(exception), exception, exception.__traceback__))
+    except Exception:
+        traceback.print_exc()
     messagebox.showinfo('Complete', 'The XTension has terminated.')
 
     # Create an ImarisLib object
@@ -25,6 +25,7 @@ display settings used to create the snapshot.
 
 import re
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import ImarisLib
 
@@ -33,17 +34,22 @@ from tkinter import messagebox
 from tkinter import filedialog
 
 VERSION = '0.1.0'
+INVALID_FILENAME_CHARS_PATTERN = re.compile(r'(?u)[^-\w.]')
 
 def make_valid_filename(name):
     # Adapted from the Django project, which is Copyright (c) Django Software
     # Foundation and individual contributors.
     name = str(name)
     name = name.strip().replace(' ', '_')
-    name = re.sub(r'(?u)[^-\w.]', '', name)
+    name = INVALID_FILENAME_CHARS_PATTERN.sub('', name)
     if name in {'', '.', '..'}:
         raise RuntimeError(f'Failed to make "{name}" into a valid filename.')
     return name
 
+def write_metadata(path, text):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
 def Main(vImarisApplication):
     image_path = vImarisApplication.GetCurrentFileName()
 
@@ -68,28 +74,50 @@ def Main(vImarisApplication):
         vCamera.GetPosition(),
     ]
 
+    vViewMode = vImarisApplication.GetViewer()
+    vVersion = vImarisApplication.GetVersion()
+
+    # Read every channel's display settings up front, so the snapshot loop
+    # below only makes the calls needed to render.
+    vChannels = [
+        (
+            make_valid_filename(vImage.GetChannelName(i)),
+            vImage.GetChannelRangeMin(i),
+            vImage.GetChannelRangeMax(i),
+            vImage.GetChannelGamma(i),
+        )
+        for i in range(vNumChannels)
+    ]
+
     # Turn off all channels.
     for i in range(vNumChannels):
         vImarisApplication.SetChannelVisibility(i, False)
 
-    # Take a snapshot of each channel, one at a time.
-    for i in range(vNumChannels):
-        vImarisApplication.SetChannelVisibility(i, True)
-        vChannelName = make_valid_filename(vImage.GetChannelName(i))
-        vSnapshotNameBase = f'{image_path}_{vChannelName}'
-        vImarisApplication.SaveSnapShot(f'{vSnapshotNameBase}.tif')
-        with open(f'{vSnapshotNameBase}.txt', 'w', encoding='utf-8') as f:
-            f.write(f'Snapshot generated by the SnapAll Imarix XTension.\n')
-            f.write(f'Channel Name: {vChannelName}\n')
-            f.write(f'Channel Index: {i}\n')
-            f.write(f'Channel Display Min: {vImage.GetChannelRangeMin(i)}\n')
-            f.write(f'Channel Display Max: {vImage.GetChannelRangeMax(i)}\n')
-            f.write(f'Channel Display Gamma: {vImage.GetChannelGamma(i)}\n')
-            f.write(f'Camera View: {vView}\n')
-            f.write(f'View Mode: {vImarisApplication.GetViewer()}\n')
-            f.write(f'Imaris Version: {vImarisApplication.GetVersion()}\n')
-            f.write(f'SnapAll Version: {VERSION}\n')
-        vImarisApplication.SetChannelVisibility(i, False)
+    # Take a snapshot of each channel, one at a time. Metadata files are
+    # written in the background while Imaris renders the next snapshot.
+    with ThreadPoolExecutor(max_workers=1) as vMetadataWriter:
+        vMetadataWrites = []
+        for i, (vChannelName, vRangeMin, vRangeMax, vGamma) in enumerate(vChannels):
+            vImarisApplication.SetChannelVisibility(i, True)
+            vSnapshotNameBase = f'{image_path}_{vChannelName}'
+            vImarisApplication.SaveSnapShot(f'{vSnapshotNameBase}.tif')
+            vMetadata = (
+                f'Snapshot generated by the SnapAll Imarix XTension.\n'
+                f'Channel Name: {vChannelName}\n'
+                f'Channel Index: {i}\n'
+                f'Channel Display Min: {vRangeMin}\n'
+                f'Channel Display Max: {vRangeMax}\n'
+                f'Channel Display Gamma: {vGamma}\n'
+                f'Camera View: {vView}\n'
+                f'View Mode: {vViewMode}\n'
+                f'Imaris Version: {vVersion}\n'
+                f'SnapAll Version: {VERSION}\n'
+            )
+            vMetadataWrites.append(vMetadataWriter.submit(write_metadata, f'{vSnapshotNameBase}.txt', vMetadata))
+            vImarisApplication.SetChannelVisibility(i, False)
+        # Surface any error from writing the metadata.
+        for vMetadataWrite in vMetadataWrites:
+            vMetadataWrite.result()
 
     print('Done.')
 
@@ -114,6 +142,6 @@ def SnapAll(aImarisId):
 
     try:
         Main(vImarisApplication)
-    except Exception as exception:
-        print(traceback.print_exception(type(exception), exception, exception.__traceback__))
+    except Exception:
+        traceback.print_exc()
     messagebox.showinfo('Complete', 'The XTension has terminated.')
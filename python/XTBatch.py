@@ -74,8 +74,12 @@ def XTBatch(
 
     curr_image_path = vImarisApplication.GetCurrentFileName()
     # extract directory for current image
-    image_folder_path='\\'.join(curr_image_path.split('\\')[:-1])
-    filenames = filenames or [f for f in os.listdir(image_folder_path) if f.endswith('.ims')]
+    image_folder_path=os.path.dirname(curr_image_path)
+    # scandir's entries already know whether they are files, so directories are
+    # skipped without a stat call per name
+    if not filenames:
+        with os.scandir(image_folder_path) as entries:
+            filenames = [e.name for e in entries if e.is_file() and e.name.endswith('.ims')]
 
     # vImarisApplication.FileSave(curr_image_path,'')
 
@@ -89,7 +93,7 @@ def XTBatch(
                 continue
         else:
             im_args = []
-        image_path=image_folder_path + '\\' + filename
+        image_path=os.path.join(image_folder_path, filename)
         vImarisApplication.FileOpen(image_path, '')
         logging.info('----- Begin Editing %s -----', image_path)
         vNumberOfImages = vImarisApplication.GetNumberOfImages()
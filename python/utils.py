@@ -1,5 +1,136 @@
+from contextlib import contextmanager
+import logging
+
 import numpy as np
 import ImarisLib
 
 def GetImageSubSliceArray(vImage,aIndexX,aIndexY,aIndexZ,aIndexC,aIndexT,aSizeX,aSizeY):
-    return np.array([np.frombuffer(row,dtype=np.uint8) for row in vImage.GetDataSubSliceBytes(aIndexX,aIndexY,aIndexZ,aIndexC,aIndexT,aSizeX,aSizeY)])
\ No newline at end of file
+    # Fetch the sub-slice as one flat bytes object (x varies fastest) rather than
+    # one bytes object per x index, and return it as the same (X, Y) array the
+    # sub-slice call gives, as a transposed view rather than a copy.
+    vData=vImage.GetDataSubVolumeAs1DArrayBytes(aIndexX=aIndexX,aIndexY=aIndexY,aIndexZ=aIndexZ,aIndexC=aIndexC,aIndexT=aIndexT,aSizeX=aSizeX,aSizeY=aSizeY,aSizeZ=1)
+    return np.frombuffer(vData,dtype=np.uint8).reshape(aSizeY,aSizeX).T
+
+
+@contextmanager
+def log_to_file(logpath, log_format):
+    """Send INFO and above from the root logger to logpath while the block runs.
+
+    Uses a handler of our own rather than logging.basicConfig, which does nothing
+    once the root logger has a handler (e.g. on a second run in the same Python
+    process) and would keep writing to the first file.
+    """
+    handler = logging.FileHandler(logpath, encoding='utf-8')
+    handler.setFormatter(logging.Formatter(log_format))
+    root_logger = logging.getLogger()
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    try:
+        yield
+    finally:
+        root_logger.removeHandler(handler)
+        handler.close()
+
+
+# Map Imaris eType to numpy dtype info
+# storage_dtype: dtype matching the raw bytes from Imaris
+# compute_dtype: a wider dtype for intermediate arithmetic (avoids overflow)
+# clip_min/clip_max: valid value range (None for float types = no clipping)
+# method_suffix: suffix for Imaris GetDataSubVolumeAs1DArray/SetDataSubVolumeAs1DArray methods
+IMAGE_TYPE_MAP = {
+    'eTypeUInt8':  (np.uint8,   np.int16,    0, 255,   'Bytes'),
+    'eTypeUInt16': (np.uint16,  np.int32,    0, 65535,  'Shorts'),
+    'eTypeFloat':  (np.float32, np.float64,  None, None, 'Floats'),
+}
+
+def get_dtype_info(vImage):
+    """Query the Imaris image type and return (storage_dtype, compute_dtype, clip_min, clip_max, method_suffix)."""
+    type_str = str(vImage.GetType())
+    if type_str in IMAGE_TYPE_MAP:
+        return IMAGE_TYPE_MAP[type_str]
+    raise ValueError(f"Unsupported image type: {type_str}. Supported types: {list(IMAGE_TYPE_MAP.keys())}")
+
+
+def saturate_cast(values, storage_dtype, clip_min, clip_max, out=None):
+    """Clip values to [clip_min, clip_max] and convert them to storage_dtype in a single pass.
+
+    out, if given, is a storage_dtype array to write the result into, so that
+    callers converting one slab after another can reuse the same buffer.
+    """
+    if values.dtype == np.bool_:
+        # Masks from comparisons are already 0/1; reinterpret them rather than copy.
+        if np.dtype(storage_dtype) == np.uint8:
+            return values.view(np.uint8)
+        return values.astype(storage_dtype)
+    if clip_min is None or clip_max is None:
+        if out is None or values.dtype == out.dtype:
+            return values.astype(storage_dtype, copy=False)
+        np.copyto(out, values, casting='unsafe')
+        return out
+    if out is None:
+        out = np.empty(np.shape(values), dtype=storage_dtype)
+    return np.clip(values, clip_min, clip_max, out=out, casting='unsafe')
+
+
+# Imaris refuses to transfer more than 512 MB in a single call, so channels are
+# moved in slabs of whole Z slices that stay under this budget.
+MAX_TRANSFER_BYTES = 256 * 1024 * 1024
+
+def get_slab_depth(vXSize, vYSize, vNumSlices, storage_dtype, max_bytes=MAX_TRANSFER_BYTES):
+    """Return the number of Z slices of one channel that fit in max_bytes (by default, one Imaris transfer)."""
+    slice_bytes = vXSize * vYSize * np.dtype(storage_dtype).itemsize
+    return max(1, min(vNumSlices, max_bytes // slice_bytes))
+
+
+def load_channel(vImage, ch_index, t, z, slab_shape, storage_dtype, method_suffix):
+    """Read a (Z, Y, X) slab of one channel starting at slice z with a single Imaris call."""
+    vSizeZ, vSizeY, vSizeX = slab_shape
+    get_sub_volume = getattr(vImage, f'GetDataSubVolumeAs1DArray{method_suffix}')
+    raw_data = get_sub_volume(aIndexX=0,aIndexY=0,aIndexZ=z,aIndexC=ch_index,aIndexT=t,aSizeX=vSizeX,aSizeY=vSizeY,aSizeZ=vSizeZ)
+    if method_suffix == 'Bytes':
+        data = np.frombuffer(raw_data, dtype=storage_dtype)
+    else:
+        # Imaris may hand back unsigned 16-bit data as signed shorts, so cast
+        # rather than construct with the storage dtype directly.
+        data = np.asarray(raw_data).astype(storage_dtype, copy=False)
+    return data.reshape(slab_shape)
+
+
+def store_channel(vImage, values, ch_index, t, z, method_suffix):
+    """Write a (Z, Y, X) slab of one channel starting at slice z as one contiguous buffer."""
+    vSizeZ, vSizeY, vSizeX = values.shape
+    set_sub_volume = getattr(vImage, f'SetDataSubVolumeAs1DArray{method_suffix}')
+    if method_suffix == 'Bytes':
+        out_data = values.tobytes()
+    elif method_suffix == 'Shorts':
+        # Imaris takes signed shorts, so send uint16 values above 32767 as
+        # their two's-complement bit patterns.
+        out_data = values.view(np.int16).ravel().tolist()
+    else:
+        out_data = values.ravel().tolist()
+    set_sub_volume(aData=out_data,aIndexX=0,aIndexY=0,aIndexZ=z,aIndexC=ch_index,aIndexT=t,aSizeX=vSizeX,aSizeY=vSizeY,aSizeZ=vSizeZ)
+
+
+def load_channel_volume(vImage, ch_index, t=0):
+    """Read a whole channel at time point t as a (Z, Y, X) array, one slab per Imaris call."""
+    storage_dtype, _, _, _, method_suffix = get_dtype_info(vImage)
+    vXSize = vImage.GetSizeX()
+    vYSize = vImage.GetSizeY()
+    vNumSlices = vImage.GetSizeZ()
+    vSlabDepth = get_slab_depth(vXSize, vYSize, vNumSlices, storage_dtype)
+    if vSlabDepth == vNumSlices:
+        return load_channel(vImage, ch_index, t, 0, (vNumSlices, vYSize, vXSize), storage_dtype, method_suffix)
+    volume = np.empty((vNumSlices, vYSize, vXSize), dtype=storage_dtype)
+    for z in range(0, vNumSlices, vSlabDepth):
+        slab_shape = (min(vSlabDepth, vNumSlices - z), vYSize, vXSize)
+        volume[z:z + slab_shape[0]] = load_channel(vImage, ch_index, t, z, slab_shape, storage_dtype, method_suffix)
+    return volume
+
+
+def store_channel_volume(vImage, volume, ch_index, t=0):
+    """Write a whole (Z, Y, X) channel at time point t, one slab per Imaris call."""
+    _, _, _, _, method_suffix = get_dtype_info(vImage)
+    vNumSlices, vYSize, vXSize = volume.shape
+    vSlabDepth = get_slab_depth(vXSize, vYSize, vNumSlices, volume.dtype)
+    for z in range(0, vNumSlices, vSlabDepth):
+        store_channel(vImage, volume[z:z + vSlabDepth], ch_index, t, z, method_suffix)